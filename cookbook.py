@@ -252,6 +252,508 @@ def demo_g2g_model():
     plt.show()
 
 
+def demo_esma_step_allocations():
+    import tracemalloc
+    import numpy as np
+    import inp
+    from model import esma_params, esma_buffers, esma_step_inplace
+
+    # inform maps files
+    ftwi = './samples/map_htwi.asc'
+    fksat = './samples/map_ksat.asc'
+
+    # load maps
+    meta, htwi = inp.asc_raster(file=ftwi, dtype='float32')
+    meta, ksat = inp.asc_raster(file=fksat, dtype='float32')
+
+    # scaled parameters
+    scale = 1000
+    prm = esma_params(
+        htwi=htwi,
+        cpmax=20,
+        sfmax=30,
+        roots=50,
+        ksat=5 * ksat,
+        rho=0.3,
+        m=5,
+        lamb=7.7,
+        scale=scale,
+    )
+
+    # deploy buffers once
+    mps, wrk = esma_buffers(shape=np.shape(htwi))
+
+    # warm up
+    for t in range(10):
+        esma_step_inplace(mps=mps, wrk=wrk, prm=prm, p=5 * scale, pet=3 * scale, d=10, t=t)
+
+    # trace memory allocations of steady-state steps
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    for t in range(10, 110):
+        esma_step_inplace(mps=mps, wrk=wrk, prm=prm, p=(t % 3) * scale, pet=3 * scale, d=10, t=t)
+    growth, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # a single map buffer is the smallest allocation worth reporting
+    map_size = wrk['tmp1'].nbytes
+    print('Map buffer size : {} bytes'.format(map_size))
+    print('Peak traced memory in 100 steps : {} bytes'.format(peak))
+    print('Memory growth in 100 steps : {} bytes'.format(growth))
+    assert peak < map_size
+
+
+def demo_esma_backends():
+    import pandas as pd
+    import inp
+    from model import esma_backends_check
+
+    # load golden run inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    df = df.query('Date < "2014-01-01"')
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+
+    # check backends against the reference numpy backend
+    check = esma_backends_check(series_df=df,
+                                backends='inplace-jit',  # jit requires numba
+                                basin=basin,
+                                htwi=htwi,
+                                qt0=0.1,
+                                cpmax=20,
+                                sfmax=30,
+                                roots=50,
+                                qo=10,
+                                m=5,
+                                lamb=7.7,
+                                ksat=5,
+                                rho=0.3,
+                                c=110,
+                                k=1,
+                                n=2.5)
+    for b in check:
+        print('{} : max diff = {} mm | OK = {}'.format(b, check[b]['Max Diff'], check[b]['OK Flag']))
+
+
+def demo_ensemble_simulation():
+    import matplotlib.pyplot as plt
+    import numpy as np
+    import pandas as pd
+    import inp
+    from model import simulation_ensemble
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+
+    # draw 50 members of m and k
+    size = 50
+    m = np.linspace(1, 20, size)
+    k = np.linspace(1, 5, size)
+
+    # advance all members together
+    ens = simulation_ensemble(series_df=df,
+                              basin=basin,
+                              htwi=htwi,
+                              qt0=0.1,
+                              cpmax=20,
+                              sfmax=30,
+                              roots=50,
+                              qo=10,
+                              m=m,
+                              lamb=7.7,
+                              ksat=5,
+                              rho=0.3,
+                              c=110,
+                              k=k,
+                              n=2.5)
+
+    # plot streamflow of members
+    for i in range(size):
+        plt.plot(df['Date'], ens['Series']['Q'][i], 'tab:grey', alpha=0.3)
+    plt.plot(df['Date'], df['Q_obs'], 'tab:red', label='Qobs')
+    plt.ylabel('mm/d')
+    plt.legend()
+    plt.show()
+
+
+def demo_glue_calibration():
+    from tools import slh_calib_g2g
+
+    # run 50k GLUE calibration in batches of 100 runs on all cpus
+    glue = slh_calib_g2g(fseries='./samples/series_obs.txt',
+                         ftwi='./samples/map_htwi.asc',
+                         fbasin='./samples/map_basin.asc',
+                         fparams='./samples/param_hydro.txt',
+                         fksat='./samples/map_ksat.asc',
+                         size=50000,
+                         batch=100,
+                         seed=2022,
+                         warmup=365,
+                         nse_min=0.5,
+                         folder='C:/bin',
+                         label='GLUE')
+    print(glue.head(15).to_string())
+
+
+def demo_simulation_stream():
+    import matplotlib.pyplot as plt
+    import numpy as np
+    import pandas as pd
+    import inp
+    from model import simulation_stream
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+
+    # aggregate the max recharge map on the fly (no trace cube)
+    scale = 1000
+    qv_max = np.zeros(np.shape(basin))
+    for step in simulation_stream(series_df=df,
+                                  basin=basin,
+                                  htwi=htwi,
+                                  qt0=0.1,
+                                  cpmax=20,
+                                  sfmax=30,
+                                  roots=50,
+                                  qo=10,
+                                  m=5,
+                                  lamb=7.7,
+                                  ksat=5,
+                                  rho=0.3,
+                                  c=110,
+                                  streamvars='Qv',
+                                  mode='active',
+                                  scale=scale):
+        np.maximum(qv_max, step['Maps']['Qv'] / scale, out=qv_max)
+        if step['t'] % 365 == 0:
+            print('{} : D = {:.2f} mm'.format(step['Date'], step['Series']['D']))
+    plt.imshow(qv_max)
+    plt.show()
+
+
+def demo_warm_restart():
+    import pandas as pd
+    import inp
+    import out
+    from model import simulation
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+    params = {'basin': basin, 'htwi': htwi, 'qt0': 0.1, 'cpmax': 20, 'sfmax': 30, 'roots': 50,
+              'qo': 10, 'm': 5, 'lamb': 7.7, 'ksat': 5, 'rho': 0.3, 'c': 110, 'k': 1, 'n': 2.5}
+
+    # spin up and save the state of the last day
+    df_spin = df.query('Date < "2019-01-01"')
+    sim = simulation(series_df=df_spin, checkpoints=['2018-12-31'], **params)
+    out.export_state(state=sim['States']['2018-12-31'], folder='C:/bin', filename='state_2018-12-31')
+
+    # warm restart from the saved state
+    state = inp.sim_state(file='C:/bin/state_2018-12-31.npz')
+    df_new = df.query('Date >= "2019-01-01"')
+    sim = simulation(series_df=df_new, state0=state, **params)
+    print(sim['Series'][['Date', 'D', 'Q', 'Q_obs']].head(15).to_string())
+
+
+def demo_nash_routing():
+    import time
+    import numpy as np
+    from model import nash_cascade, nash_recursive
+
+    # ten years of synthetic runoff
+    q = np.random.default_rng(0).exponential(2, size=3650)
+    for method in ['direct', 'fft', 'recursive']:
+        t0 = time.time()
+        qs = nash_cascade(q, k=3, n=2, method=method)
+        print('{} : {:.4f} s | Q sum = {:.6f}'.format(method, time.time() - t0, qs.sum()))
+    # truncated unit hydrograph
+    qs = nash_cascade(q, k=3, n=2, method='fft', tol=1e-6)
+    print('fft tol=1e-6 : Q sum = {:.6f}'.format(qs.sum()))
+    # carry the reservoirs state across chunks
+    qs1, zf = nash_recursive(q[:1000], k=3, n=2)
+    qs2, zf = nash_recursive(q[1000:], k=3, n=2, zi=zf)
+    print('chunked : Q sum = {:.6f}'.format(qs1.sum() + qs2.sum()))
+
+
+def demo_distributed_pet():
+    import numpy as np
+    import pandas as pd
+    import inp
+    import geo
+    from model import pet_field, simulation
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+    meta_dem, dem = inp.tif_raster(file='./samples/tif/dem.tif', dtype='float32')
+    print(meta_dem['crs'])
+
+    # per-cell latitude from the raster metadata (UTM zone 21S) and lapsed temperature
+    field = pet_field(latitude=geo.latitude(meta=meta_dem, utm=True, zone_south=True),
+                      elevation=dem.astype('float64'),
+                      lapse=0.0065,
+                      block_rows=32)
+    sim = simulation(series_df=df,
+                     basin=basin,
+                     htwi=htwi,
+                     qt0=0.1,
+                     cpmax=20,
+                     sfmax=30,
+                     roots=50,
+                     qo=10,
+                     m=5,
+                     lamb=7.7,
+                     ksat=5,
+                     rho=0.3,
+                     c=110,
+                     k=1,
+                     n=2.5,
+                     mode='active',
+                     pet_field=field)
+    print('PET = {:.1f} mm | ET = {:.1f} mm'.format(sim['Series']['PET'].sum(), sim['Series']['ET'].sum()))
+
+
+def demo_float32_precision():
+    import time
+    import numpy as np
+    import pandas as pd
+    import inp
+    from model import simulation
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+
+    # compare packed and float32 maps
+    sims = dict()
+    for precision in ['packed', 'float32']:
+        t0 = time.time()
+        sims[precision] = simulation(series_df=df,
+                                     basin=basin,
+                                     htwi=htwi,
+                                     qt0=0.1,
+                                     cpmax=20,
+                                     sfmax=30,
+                                     roots=50,
+                                     qo=10,
+                                     m=5,
+                                     lamb=7.7,
+                                     ksat=5,
+                                     rho=0.3,
+                                     c=110,
+                                     k=1,
+                                     n=2.5,
+                                     trace=True,
+                                     tracevars='D',
+                                     backend='inplace',
+                                     precision=precision)
+        print('{} : {:.2f} s'.format(precision, time.time() - t0))
+        for v in sims[precision]['Memory']:
+            print('   {} : {:.3f} MB'.format(v, sims[precision]['Memory'][v]))
+    # packed traces wrap above 65.535 mm
+    print('max traced D : packed = {} mm | float32 = {} mm'.format(sims['packed']['Trace']['D'].max() / 1000,
+                                                                 sims['float32']['Trace']['D'].max()))
+    print('max Q diff = {} mm'.format(np.max(np.abs(sims['packed']['Series']['Q'] - sims['float32']['Series']['Q']))))
+
+
+def demo_label_series():
+    import numpy as np
+    import pandas as pd
+    import inp
+    from model import simulation
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+
+    # label raster of 3 sub-basins (west, center and east)
+    cols = np.ones(np.shape(basin), dtype='int32') * np.arange(np.shape(basin)[1])
+    labels = 1 + (3 * cols // np.shape(basin)[1])
+
+    sim = simulation(series_df=df,
+                     basin=basin,
+                     htwi=htwi,
+                     qt0=0.1,
+                     cpmax=20,
+                     sfmax=30,
+                     roots=50,
+                     qo=10,
+                     m=5,
+                     lamb=7.7,
+                     ksat=5,
+                     rho=0.3,
+                     c=110,
+                     k=1,
+                     n=2.5,
+                     mode='active',
+                     backend='inplace',
+                     labels=labels,
+                     labelvars='Q-R-ET-VSA')
+    # tidy table of label series
+    print(sim['Labels'].head())
+    print(sim['Labels'].groupby(level='Label').sum())
+
+
+def demo_period_aggregation():
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import inp
+    from model import simulation
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+
+    # seasonal maps without tracing
+    sim = simulation(series_df=df,
+                     basin=basin,
+                     htwi=htwi,
+                     qt0=0.1,
+                     cpmax=20,
+                     sfmax=30,
+                     roots=50,
+                     qo=10,
+                     m=5,
+                     lamb=7.7,
+                     ksat=5,
+                     rho=0.3,
+                     c=110,
+                     k=1,
+                     n=2.5,
+                     backend='inplace',
+                     aggregate='season',
+                     aggregatevars='D-ET')
+    periods = sim['Aggregation']['Periods']
+    print(periods)
+    # plot ET maps of the first 4 seasons
+    fig, axes = plt.subplots(1, 4)
+    for i in range(4):
+        lcl_period = periods['Period'].values[i]
+        axes[i].imshow(sim['Aggregation']['Maps']['ET'][lcl_period] / 1000, cmap='viridis_r')
+        axes[i].set_title(lcl_period)
+        axes[i].axis('off')
+    plt.show()
+
+
+def demo_cell_stats():
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import inp
+    from model import simulation
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+
+    # per-cell statistics in one pass without tracing
+    sim = simulation(series_df=df,
+                     basin=basin,
+                     htwi=htwi,
+                     qt0=0.1,
+                     cpmax=20,
+                     sfmax=30,
+                     roots=50,
+                     qo=10,
+                     m=5,
+                     lamb=7.7,
+                     ksat=5,
+                     rho=0.3,
+                     c=110,
+                     k=1,
+                     n=2.5,
+                     backend='inplace',
+                     stats='max-mean-std-p95',
+                     statsvars='Qv-VSA')
+    print(sim['Memory'])
+    # plot 95th-percentile recharge and saturation frequency
+    fig, axes = plt.subplots(1, 2)
+    axes[0].imshow(sim['Stats']['Qv']['p95'] / 1000, cmap='viridis_r')
+    axes[0].set_title('Qv p95')
+    axes[1].imshow(sim['Stats']['VSA']['mean'], cmap='Blues')
+    axes[1].set_title('VSA frequency')
+    for ax in axes:
+        ax.axis('off')
+    plt.show()
+
+
+def demo_selective_outputs():
+    import time
+    import pandas as pd
+    import inp
+    from model import simulation, esma_needs
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+    params = dict(series_df=df, basin=basin, htwi=htwi, qt0=0.1, cpmax=20, sfmax=30,
+                  roots=50, qo=10, m=5, lamb=7.7, ksat=5, rho=0.3, c=110, k=1, n=2.5,
+                  backend='inplace')
+    # variables evaluated for an objective function of Q and ET
+    print(esma_needs(seriesvars=['Q', 'ET']))
+    for outputs in [None, 'Q-ET']:
+        t0 = time.time()
+        sim = simulation(outputs=outputs, **params)
+        print('outputs: {} | {:.2f} s'.format(outputs, time.time() - t0))
+        print(list(sim['Series'].columns))
+
+
+def demo_events_backend():
+    import time
+    import pandas as pd
+    import inp
+    from model import simulation, esma_backends_check
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+    params = dict(basin=basin, htwi=htwi, qt0=0.1, cpmax=20, sfmax=30, roots=50, qo=10,
+                  m=5, lamb=7.7, ksat=5, rho=0.3, c=110, k=1, n=2.5, mode='active')
+    # the event-driven kernel must be identical to the in-place kernel
+    print(esma_backends_check(df, backends='events', tol=0, reference='inplace', **params))
+    for backend in ['inplace', 'events']:
+        t0 = time.time()
+        simulation(series_df=df, backend=backend, **params)
+        print('{} : {:.2f} s'.format(backend, time.time() - t0))
+
+
+def demo_simulation_cache():
+    import os
+    import time
+    import numpy as np
+    import pandas as pd
+    import inp
+    from model import simulation_cached
+
+    # load inputs
+    df = pd.read_csv('./samples/series_obs.txt', sep=';', parse_dates=['Date'])
+    meta, htwi = inp.asc_raster(file='./samples/map_htwi.asc', dtype='float32')
+    meta, basin = inp.asc_raster(file='./samples/map_basin.asc', dtype='float32')
+    params = dict(basin=basin, htwi=htwi, qt0=0.1, cpmax=20, sfmax=30, roots=50, qo=10,
+                  m=5, lamb=7.7, ksat=5, rho=0.3, c=110, k=1, n=2.5, trace=True, tracevars='D-VSA')
+    cache_folder = 'C:/bin/sim_cache'
+    os.makedirs(cache_folder, exist_ok=True)
+    # the first call simulates, the rerun is loaded from the cache
+    runs = list()
+    for i in range(2):
+        t0 = time.time()
+        runs.append(simulation_cached(cache_folder=cache_folder, cache_size=500, series_df=df, **params))
+        print('run {} : {:.2f} s'.format(i, time.time() - t0))
+    print(runs[0]['Series'].equals(runs[1]['Series']))
+    print(np.array_equal(runs[0]['Trace']['D'], runs[1]['Trace']['D']))
+
+
 #demo_plot_scalar_map_batch()
 
 demo_g2g_model()
\ No newline at end of file
@@ -254,3 +254,61 @@ def usle_s(slope):
     slope_rad = np.pi * 2 * slope / 360
     lcl_grad = np.sin(slope_rad)
     return (65.41 * np.power(lcl_grad, 2)) + (4.56 * lcl_grad) + 0.065
+
+
+def utm_latitude(easting, northing, zone_south=True):
+    """
+    Latitude of UTM coordinates (inverse Transverse Mercator series of Snyder, 1987 -
+    GRS80 / WGS84 ellipsoid)
+    :param easting: float or array of UTM easting in meters
+    :param northing: float or array of UTM northing in meters
+    :param zone_south: boolean to southern hemisphere zones (false northing of 10000 km)
+    :return: float or array of latitude in degrees
+    """
+    a = 6378137.0
+    f = 1 / 298.257222101
+    k0 = 0.9996
+    e2 = f * (2 - f)
+    ep2 = e2 / (1 - e2)
+    x = easting - 500000.0
+    y = northing - (10000000.0 * zone_south)
+    # footpoint latitude
+    mu = (y / k0) / (a * (1 - e2 / 4 - 3 * e2**2 / 64 - 5 * e2**3 / 256))
+    e1 = (1 - np.sqrt(1 - e2)) / (1 + np.sqrt(1 - e2))
+    phi1 = (
+        mu
+        + (3 * e1 / 2 - 27 * e1**3 / 32) * np.sin(2 * mu)
+        + (21 * e1**2 / 16 - 55 * e1**4 / 32) * np.sin(4 * mu)
+        + (151 * e1**3 / 96) * np.sin(6 * mu)
+        + (1097 * e1**4 / 512) * np.sin(8 * mu)
+    )
+    c1 = ep2 * np.cos(phi1) ** 2
+    t1 = np.tan(phi1) ** 2
+    n1 = a / np.sqrt(1 - e2 * np.sin(phi1) ** 2)
+    r1 = a * (1 - e2) / np.power(1 - e2 * np.sin(phi1) ** 2, 1.5)
+    d = x / (n1 * k0)
+    phi = phi1 - (n1 * np.tan(phi1) / r1) * (
+        d**2 / 2
+        - (5 + 3 * t1 + 10 * c1 - 4 * c1**2 - 9 * ep2) * d**4 / 24
+        + (61 + 90 * t1 + 298 * c1 + 45 * t1**2 - 252 * ep2 - 3 * c1**2) * d**6 / 720
+    )
+    return phi * 180 / np.pi
+
+
+def latitude(meta, utm=True, zone_south=True):
+    """
+    Latitude of raster cell centers
+    :param meta: dicitonary of raster metadata (see inp.asc_raster())
+    :param utm: boolean to UTM coordinates (false to geographic coordinates in degrees)
+    :param zone_south: boolean to southern hemisphere UTM zones
+    :return: 2d array of latitude in degrees
+    """
+    cols = np.arange(meta["ncols"])
+    rows = np.arange(meta["nrows"])
+    x = meta["xllcorner"] + (cols + 0.5) * meta["cellsize"]
+    y = meta["yllcorner"] + (meta["nrows"] - rows - 0.5) * meta["cellsize"]
+    if utm:
+        return utm_latitude(
+            easting=x[np.newaxis, :], northing=y[:, np.newaxis], zone_south=zone_south
+        )
+    return y[:, np.newaxis] * np.ones(shape=(1, meta["ncols"]))
@@ -129,6 +129,39 @@ def asc_raster(file, nan=False, dtype="int16"):
     return meta_dct, def_array
 
 
+def tif_raster(file, dtype="float32"):
+    """
+    A function to import single band GeoTIFF raster files (requires Pillow).
+    The metadata dictionary has the same keys of asc_raster() plus the 'crs'
+    citation string (e.g. 'SIRGAS 2000 / UTM zone 21S').
+    Cells of the GDAL no data value are converted to np.nan in float data types.
+    :param file: string of file path with the '.tif' extension
+    :param dtype: string code to data type. Options: 'int16', 'int32', 'float32' etc
+    :return: 1) metadata dictionary and 2) numpy 2d array
+    """
+    from PIL import Image
+
+    with Image.open(file) as img:
+        tags = img.tag_v2
+        def_array = np.array(img, dtype=dtype)
+    # GeoTIFF tags: pixel scale, tie point, GDAL no data and ASCII citation
+    cellsize = tags[33550][0]
+    tiepoint = tags[33922]
+    meta_dct = {
+        "ncols": np.shape(def_array)[1],
+        "nrows": np.shape(def_array)[0],
+        "xllcorner": tiepoint[3],
+        "yllcorner": tiepoint[4] - np.shape(def_array)[0] * cellsize,
+        "cellsize": cellsize,
+        "NODATA_value": float(tags.get(42113, -9999)),
+        "crs": str(tags.get(34737, "")).split("|")[0],
+    }
+    # replace NoData value by np.nan
+    if 42113 in tags and np.issubdtype(def_array.dtype, np.floating):
+        def_array[def_array == meta_dct["NODATA_value"]] = np.nan
+    return meta_dct, def_array
+
+
 def hydroparams(fhydroparam):
     """
     Import the hydrology reference parameters to a dictionary.
@@ -170,6 +203,27 @@ def hydroparams(fhydroparam):
     return hydroparams_dct, hydroparam_df
 
 
+def sim_state(file):
+    """
+    Import a simulation state .NPZ file (see out.export_state())
+    :param file: string of file path with the '.npz' extension
+    :return: dictionary of simulation state (see model.esma_state())
+    """
+    with np.load(file) as npz:
+        state = {
+            "Date": npz["Date"].astype("datetime64[ns]"),
+            "scale": int(npz["scale"]),
+            "Qs": npz["Qs"],
+            "Maps": dict(),
+        }
+        for v in ["D", "Qb", "Tps", "Qv"]:
+            state[v] = float(npz[v])
+        for v in npz.files:
+            if v.startswith("map_"):
+                state["Maps"][v[4:]] = npz[v]
+    return state
+
+
 # deprecated
 def dataframe_prepro(
     dataframe, strfields="Field1,Field2", strf=True, date=False, datefield="Date"
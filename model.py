@@ -45,6 +45,14 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import matplotlib.pyplot as plt
 import numpy as np
 
+NASH_CACHE_SIZE = 64  # max number of cached Nash unit hydrographs
+EVENTS_RATIO = 0.2  # max fraction of active cells of the event-driven branches
+REDUCE_COLS = 16384  # columns of the float64 blocks reducing float32 maps
+
+_nash_kernel_cache = dict()
+_pet_het_cache = dict()
+_esma_jit_cache = dict()
+
 
 def avg_2d(var2d, weight):
     """
@@ -57,30 +65,321 @@ def avg_2d(var2d, weight):
     return np.round(lcl_avg, decimals=4)
 
 
-def nash_cascade(q, k, n):
+def avg_cells(var, count=None):
     """
-    Runoff routing model of multiple linear reservoirs (Nash Cascade)
-    :param q: 1d numpy array of runoff
+    average value over all simulated cells
+    :param var: numpy array of simulated values (grid or domain units)
+    :param count: None (each element is one cell) or numpy array of number of cells per element
+    :return: float average value
+    """
+    if count is None:
+        return np.mean(var)
+    return np.sum(var * count) / np.sum(count)
+
+
+def hru_domain(basin, htwi, cpmax, sfmax, roots, ksat, bins=100):
+    """
+    Collapse the basin grid into unique hydrologic response units (HRU).
+    An HRU is a unique combination of HTWI bin, cpmax, sfmax, roots and ksat inside the basin mask.
+    :param basin: 2d numpy array of basin area
+    :param htwi: 2d numpy array of HTWI map
+    :param cpmax: float or 2d numpy array of canopy water stock capacity in mm
+    :param sfmax: float or 2d numpy array of surface water stock capacity in mm
+    :param roots: float or 2d numpy array of effective root zone depth in mm
+    :param ksat: float or 2d numpy array of daily hydraulic conductivity in mm/d
+    :param bins: int number of HTWI bins
+    :return: python dict containing:
+
+    {'Map': 2d numpy array of HRU ids (-1 outside the basin),
+     'Weight': 1d numpy array of basin weight of each HRU,
+     'Count': 1d numpy array of number of cells of each HRU,
+     'HTWI': 1d numpy array of average HTWI of each HRU,
+     'cpmax', 'sfmax', 'roots', 'ksat': float or 1d numpy array of each HRU}
+
+    """
+    mask = basin > 0
+    weight = basin[mask]
+    twi = htwi[mask]
+    # bin HTWI values
+    edges = np.linspace(np.min(twi), np.max(twi), bins + 1)
+    twi_bin = np.digitize(twi, edges[1:-1])
+    # stack keys of HRU combinations
+    keys = [twi_bin]
+    params = {"cpmax": cpmax, "sfmax": sfmax, "roots": roots, "ksat": ksat}
+    for p in params:
+        if np.ndim(params[p]) > 0:
+            keys.append(params[p][mask])
+    keys = np.stack(keys, axis=1)
+    # get unique combinations
+    units, ids = np.unique(keys, axis=0, return_inverse=True)
+    ids = ids.flatten()
+    size = len(units)
+    # deploy HRU map
+    hru_map = -1 * np.ones(shape=np.shape(basin), dtype="int32")
+    hru_map[mask] = ids
+    # HRU weights and HTWI
+    count = np.bincount(ids, minlength=size)
+    hru_weight = np.bincount(ids, weights=weight, minlength=size)
+    hru_twi = np.bincount(ids, weights=twi, minlength=size) / count
+    dct = {"Map": hru_map, "Weight": hru_weight, "Count": count, "HTWI": hru_twi}
+    # HRU parameters
+    for p in params:
+        if np.ndim(params[p]) > 0:
+            lcl_values = np.zeros(size, dtype="float64")
+            lcl_values[ids] = params[p][mask]
+            dct[p] = lcl_values
+        else:
+            dct[p] = params[p]
+    return dct
+
+
+def active_domain(basin, htwi, cpmax, sfmax, roots, ksat):
+    """
+    Pack the active cells of the basin (basin > 0) into 1d domain units.
+    No data cells outside the basin are dropped from the simulation.
+    :param basin: 2d numpy array of basin area
+    :param htwi: 2d numpy array of HTWI map
+    :param cpmax: float or 2d numpy array of canopy water stock capacity in mm
+    :param sfmax: float or 2d numpy array of surface water stock capacity in mm
+    :param roots: float or 2d numpy array of effective root zone depth in mm
+    :param ksat: float or 2d numpy array of daily hydraulic conductivity in mm/d
+    :return: python dict containing:
+
+    {'Map': 2d numpy array of cell ids (-1 outside the basin),
+     'Weight': 1d numpy array of basin weight of each cell,
+     'Count': None (one cell per unit),
+     'HTWI': 1d numpy array of HTWI of each cell,
+     'cpmax', 'sfmax', 'roots', 'ksat': float or 1d numpy array of each cell}
+
+    """
+    mask = basin > 0
+    size = np.sum(mask)
+    # deploy cell map
+    cell_map = -1 * np.ones(shape=np.shape(basin), dtype="int32")
+    cell_map[mask] = np.arange(size)
+    dct = {"Map": cell_map, "Weight": basin[mask], "Count": None, "HTWI": htwi[mask]}
+    # cell parameters
+    params = {"cpmax": cpmax, "sfmax": sfmax, "roots": roots, "ksat": ksat}
+    for p in params:
+        if np.ndim(params[p]) > 0:
+            dct[p] = params[p][mask]
+        else:
+            dct[p] = params[p]
+    return dct
+
+
+def domain_scatter(values, ids, nodata=0):
+    """
+    Scatter domain unit values back to 2d maps
+    :param values: nd numpy array of domain values (last axis is the domain units)
+    :param ids: 2d numpy array of unit ids (negative ids for no data cells)
+    :param nodata: value for no data cells
+    :return: nd numpy array of maps (last two axis are rows and cols)
+    """
+    mask = ids >= 0
+    maps = np.full(np.shape(values)[:-1] + np.shape(ids), nodata, dtype=values.dtype)
+    maps[..., mask] = values[..., ids[mask]]
+    return maps
+
+
+def label_domain(labels, basin, ids=None):
+    """
+    Weights of simulation domain units in each label (sub-basin) of a label raster.
+    Every (unit, label) pair is weighted by the basin weight of its cells, so labels
+    are averaged with one bincount pass in any simulation domain (see label_average()).
+    :param labels: 2d numpy array of integer labels (labels <= 0 are not aggregated)
+    :param basin: 2d numpy array of basin area
+    :param ids: None or 2d numpy array of domain unit ids (see active_domain() and hru_domain()).
+    None for grid domain (units are the flat cells)
+    :return: dict of label domain
+    """
+    mask = (labels > 0) * (basin > 0)
+    if ids is None:
+        units = np.flatnonzero(mask)
+    else:
+        mask = mask * (ids >= 0)
+        units = ids[mask]
+    lbl_ids, lbl_index = np.unique(labels[mask], return_inverse=True)
+    # collapse cells into (unit, label) pairs
+    pairs, pairs_index = np.unique(
+        units.astype("int64") * len(lbl_ids) + lbl_index, return_inverse=True
+    )
+    weight = np.bincount(pairs_index, weights=basin[mask])
+    pairs_lbl = pairs % len(lbl_ids)
+    # normalize weights by label
+    weight = weight / np.bincount(pairs_lbl, weights=weight)[pairs_lbl]
+    return {
+        "Labels": lbl_ids,
+        "Units": pairs // len(lbl_ids),
+        "Index": pairs_lbl,
+        "Weight": weight,
+    }
+
+
+def label_average(values, lbl, tmp=None):
+    """
+    Average of domain unit values in each label
+    :param values: numpy array of domain unit values
+    :param lbl: dict of label domain (see label_domain())
+    :param tmp: None or preallocated 1d numpy array of the number of (unit, label) pairs
+    :return: 1d numpy array of label averages
+    """
+    if tmp is None:
+        tmp = np.zeros(len(lbl["Units"]), dtype=np.asarray(values).dtype)
+    values = np.ravel(values)
+    if values.dtype == tmp.dtype:
+        np.take(values, lbl["Units"], out=tmp)
+    else:
+        tmp[...] = values[lbl["Units"]]
+    np.multiply(tmp, lbl["Weight"], out=tmp)
+    return np.bincount(lbl["Index"], weights=tmp, minlength=len(lbl["Labels"]))
+
+
+def nash_kernel(k, n, size):
+    """
+    Nash Cascade unit hydrograph
     :param k: float of residence time in time step units
     :param n: float of equivalent number of reservoirs in Nash Cascade
-    :return: 1d numpy array of routed runoff
+    :param size: int number of time steps
+    :return: 1d numpy array of the Nash Cascade time function
     """
     from scipy.special import gamma
 
-    size = len(q)
     time = np.arange(0, size)
-    nash = (
-        np.power((time / k), (n - 1)) * np.exp(-time / k) / (k * gamma(n))
-    )  # the Nash Cascade time function
-    for t in range(0, len(time)):
-        lcl_q = q[t]
-        if t == 0:
-            qs = lcl_q * nash
+    return np.power((time / k), (n - 1)) * np.exp(-time / k) / (k * gamma(n))
+
+
+def nash_kernel_cached(k, n, size, tol=None):
+    """
+    Nash Cascade unit hydrograph from a bounded LRU cache (see nash_kernel())
+    :param k: float of residence time in time step units
+    :param n: float of equivalent number of reservoirs in Nash Cascade
+    :param size: int number of time steps
+    :param tol: None or float of volume fraction left out to truncate the unit hydrograph
+    (see nash_horizon())
+    :return: 1d read-only numpy array of the Nash Cascade time function
+    """
+    key = (float(k), float(n), int(size), tol)
+    if key in _nash_kernel_cache:
+        # move to the most recently used end
+        nash = _nash_kernel_cache.pop(key)
+    else:
+        if tol is not None:
+            size = min(size, nash_horizon(k=k, n=n, tol=tol))
+        nash = nash_kernel(k=k, n=n, size=size)
+        nash.flags.writeable = False
+        if len(_nash_kernel_cache) >= NASH_CACHE_SIZE:
+            # evict the least recently used kernel
+            del _nash_kernel_cache[next(iter(_nash_kernel_cache))]
+    _nash_kernel_cache[key] = nash
+    return nash
+
+
+def nash_cascade(q, k, n, method="auto", tol=None):
+    """
+    Runoff routing model of multiple linear reservoirs (Nash Cascade)
+    :param q: 1d numpy array of runoff or 2d numpy array of many runoff series
+    (ensemble members, sub-basins) routed at once with the same unit hydrograph
+    :param k: float of residence time in time step units
+    :param n: float of equivalent number of reservoirs in Nash Cascade
+    :param method: string of routing method. Options:
+    'direct' - explicit superposition of unit hydrographs, O(size^2);
+    'fft' - FFT convolution, O(size log size);
+    'recursive' - exact recursive cascade for integer n, O(n size) (see nash_recursive());
+    'auto' - 'recursive' for integer n, 'fft' for long series and 'direct' otherwise
+    :param tol: None or float of volume fraction left out to truncate the unit hydrograph
+    (see nash_horizon()). Not used by the 'recursive' method.
+    :return: numpy array of routed runoff (same shape of q)
+    """
+    q = np.asarray(q, dtype="float64")
+    size = np.shape(q)[-1]
+    if method == "auto":
+        if n == int(n):
+            method = "recursive"
+        elif size > 256:
+            method = "fft"
         else:
-            qs[t:] = qs[t:] + lcl_q * nash[: size - t]
+            method = "direct"
+    methods = ["direct", "fft", "recursive"]
+    if method not in methods:
+        raise ValueError(
+            "Method '{}' not found. Options: {}".format(method, methods + ["auto"])
+        )
+    if method == "recursive":
+        qs, zf = nash_recursive(q=q, k=k, n=n)
+        return qs
+    # the Nash Cascade time function
+    nash = nash_kernel_cached(k=k, n=n, size=size, tol=tol)
+    ksize = len(nash)
+    if method == "fft":
+        from scipy.signal import fftconvolve
+
+        nash = np.reshape(nash, (1,) * (q.ndim - 1) + (ksize,))
+        return fftconvolve(q, nash, axes=-1)[..., :size]
+    qs = np.zeros(np.shape(q), dtype="float64")
+    for t in range(0, size):
+        lcl_size = min(ksize, size - t)
+        qs[..., t : t + lcl_size] = (
+            qs[..., t : t + lcl_size] + q[..., t, None] * nash[:lcl_size]
+        )
     return qs
 
 
+def nash_recursive(q, k, n, zi=None):
+    """
+    Exact recursive Nash Cascade for integer number of reservoirs. The sampled unit
+    hydrograph of nash_kernel() is the impulse response of a n-order recursive filter,
+    so routing costs O(n size) and the reservoirs state can be carried to the next call.
+    :param q: 1d numpy array of runoff or 2d numpy array of many runoff series
+    :param k: float of residence time in time step units
+    :param n: int number of reservoirs in Nash Cascade
+    :param zi: None or numpy array of initial reservoirs state (zf of a previous call)
+    :return: numpy array of routed runoff and numpy array of final reservoirs state
+    """
+    from scipy.signal import lfilter
+    from scipy.special import comb
+
+    if n != int(n):
+        raise ValueError("Recursive Nash Cascade needs an integer n, got {}".format(n))
+    n = int(n)
+    # denominator: n repeated poles at exp(-1/k)
+    decay = np.exp(-1 / k)
+    den = np.array([comb(n, i) * (-decay) ** i for i in range(n + 1)])
+    # numerator: first n terms of the unit hydrograph times the denominator
+    num = np.convolve(den, nash_kernel_cached(k=k, n=n, size=n + 1))[:n]
+    if zi is None:
+        zi = np.zeros(np.shape(q)[:-1] + (n,), dtype="float64")
+    return lfilter(num, den, q, axis=-1, zi=zi)
+
+
+def nash_horizon(k, n, tol=1e-9):
+    """
+    Number of time steps of the Nash Cascade unit hydrograph holding all but tol of its volume
+    :param k: float of residence time in time step units
+    :param n: float of equivalent number of reservoirs in Nash Cascade
+    :param tol: float of volume fraction left out
+    :return: int number of time steps
+    """
+    from scipy.stats import gamma
+
+    return int(np.ceil(gamma.isf(tol, a=n, scale=k))) + 1
+
+
+def nash_pending(q, k, n, size):
+    """
+    Routed runoff still pending in the Nash Cascade after the end of the runoff series
+    :param q: 1d numpy array of runoff
+    :param k: float of residence time in time step units
+    :param n: float of equivalent number of reservoirs in Nash Cascade
+    :param size: int number of time steps after the end of the runoff series
+    :return: 1d numpy array of pending routed runoff
+    """
+    from scipy.signal import fftconvolve
+
+    nash = nash_kernel_cached(k=k, n=n, size=len(q) + size)
+    return fftconvolve(q, nash)[len(q) : len(q) + size]
+
+
 #
 #
 #
@@ -171,6 +470,21 @@ def pet_daily_hetrad(day, latitude):
     return het / (1000000)  # MJ/(d * m2)
 
 
+def pet_hetrad_table(latitude):
+    """
+    PET model - Lookup table of the Horizontal Daily Extraterrestrial Radiation by Julian day.
+    Tables are cached by latitude.
+    :param latitude: float - latitude in [radians]
+    :return: 1d read-only numpy array of 367 HET values in [MJ/(d * m2)] (index is the Julian day)
+    """
+    key = float(latitude)
+    if key not in _pet_het_cache:
+        het = pet_daily_hetrad(day=np.arange(0, 367), latitude=key)
+        het.flags.writeable = False
+        _pet_het_cache[key] = het
+    return _pet_het_cache[key]
+
+
 def pet_latent_heat_flux():
     """
     PET model - Latent Heat Flux of water in MJ/kg
@@ -197,7 +511,11 @@ def pet_oudin(temperature, day, latitude, k1=100, k2=5):
     :param k2: Minimum air temperature [C]
     :return: Potential Evapotranspiration in [mm/d]
     """
-    het = pet_daily_hetrad(day, latitude)
+    if np.ndim(latitude) == 0 and np.issubdtype(np.asarray(day).dtype, np.integer):
+        # gather from the cached table
+        het = pet_hetrad_table(latitude=latitude)[day]
+    else:
+        het = pet_daily_hetrad(day, latitude)
     pet = (
         (1000 * het / (pet_latent_heat_flux() * pet_water_spmass() * k1))
         * (temperature + k2)
@@ -207,6 +525,66 @@ def pet_oudin(temperature, day, latitude, k1=100, k2=5):
     return pet
 
 
+def pet_field(
+    latitude, elevation, zref=None, lapse=0.0065, lat_res=0.01, block_rows=64
+):
+    """
+    PET model - Setup of distributed PET maps (see pet_oudin_field()). The HET of cells
+    is taken from day-of-year tables of latitude bands, so the day-of-year terms are
+    computed once for all cells.
+    :param latitude: 2d numpy array of cells latitude in degrees (see geo.latitude())
+    :param elevation: 2d numpy array of cells elevation in meters (nan for no data)
+    :param zref: None or float of elevation in meters of the temperature series (None for the mean)
+    :param lapse: float of temperature lapse rate in [C/m]
+    :param lat_res: float of latitude bands resolution in degrees
+    :param block_rows: int number of rows evaluated at once
+    :return: python dict of PET field setup
+    """
+    # latitude bands
+    bands = np.round(latitude / lat_res).astype("int64")
+    bands_ids, bands_map = np.unique(bands, return_inverse=True)
+    bands_lat = bands_ids * lat_res * np.pi / 180  # convert lat from degrees to radians
+    table = pet_daily_hetrad(
+        day=np.arange(0, 367)[:, np.newaxis], latitude=bands_lat[np.newaxis, :]
+    )
+    # temperature offsets
+    if zref is None:
+        zref = np.nanmean(elevation)
+    offset = -lapse * (elevation - zref)
+    offset[np.isnan(offset)] = 0.0
+    return {
+        "Table": table,
+        "Bands": np.reshape(bands_map, np.shape(latitude)).astype("int32"),
+        "Offset": offset.astype("float64"),
+        "Rows": block_rows,
+    }
+
+
+def pet_oudin_field(field, temperature, day, out, k1=100, k2=5):
+    """
+    PET Oudin Model - Distributed PET map of one day evaluated in row blocks,
+    with temperature lapsed by elevation. Only one map is allocated (out).
+    :param field: python dict of PET field setup (see pet_field())
+    :param temperature: float of daily average temperature in [C] at the reference elevation
+    :param day: int Julian day
+    :param out: 2d numpy array to store the PET map in [mm/d]
+    :param k1: Scalar parameter in [C * m/mm]
+    :param k2: Minimum air temperature [C]
+    :return: 2d numpy array of Potential Evapotranspiration in [mm/d] (out)
+    """
+    het = field["Table"][day]
+    factor = 1000 / (pet_latent_heat_flux() * pet_water_spmass() * k1)
+    rows = field["Rows"]
+    for i in range(0, len(out), rows):
+        lcl_out = out[i : i + rows]
+        # lapsed temperature
+        np.add(field["Offset"][i : i + rows], temperature + k2, out=lcl_out)
+        np.maximum(lcl_out, 0.0, out=lcl_out)
+        np.multiply(lcl_out, het[field["Bands"][i : i + rows]], out=lcl_out)
+        np.multiply(lcl_out, factor, out=lcl_out)
+    return out
+
+
 def topmodel_d0(qt0, qo, m):
     """
     TOPMODEL Deficit as a function of baseflow (Beven and Kirkby, 1979)
@@ -267,91 +645,12 @@ def topmodel_vsai(di):
     return (di == 0) * 1
 
 
-def simulation(
-    series_df,
-    basin,
-    htwi,
-    qt0,
-    cpmax,
-    sfmax,
-    roots,
-    qo,
-    m,
-    lamb,
-    ksat,
-    rho,
-    c,
-    n,
-    k,
-    scale=1000,
-    lat=-30,
-    trace=False,
-    tracevars="D-Cp",
-    integrate=False,
-    integratevars="D-Qv",
-):
+def esma_simvars():
     """
-
-    g2g simulation model
-
-    Simulated variables:
-
-    'D',    # saturated water stock deficit
-    'Vz',   # vadose (unsaturated) zone water stock
-    'Sf',   # surface water stock
-    'Cp',   # canopy water stock
-    'VSA',  # variable source area
-    'P',    # precipitation
-    'PET',  # potential evapotranspiration
-    'Inc',  # interceptation in canopy
-    'Ins',  # interceptation in surface
-    'TF',   # throughfall
-    'R',    # runoff
-    'RIE',  # infiltration excess runoff (Hortonian)
-    'RSE',  # saturation excess runoff (Dunnean)
-    'RC',   # runofff coeficient (%)
-    'Inf',  # infiltration
-    'Qv',   # recharge
-    'Evc',  # evaporation from the canopy
-    'Evs',  # evaporation from the surface
-    'Tpu', # transpiration from the unsaturated zone
-    'Tps', # transpiration from the saturated zone
-    'ET',   # evapotranspiration
-    'Qb',   # baseflow
-    'Qs',   # stormflow
-    'Q'     # streamflow
-
-    :param series_df: pandas dataframe of timeseries
-    :param basin: 2d numpy array of basin area
-    :param htwi: numpy array of HTWI map (positive values only)
-    :param qt0: float of initial condition of baseflow in mm/d
-    :param cpmax: float or 2d numpy array of canopy water stock capacity in mm
-    :param sfmax: float or 2d numpy array of surface water stock capacity in mm
-    :param roots: float or 2d numpy array of effective root zone depth in mm
-    :param qo: float of full saturation baseflow in mm/d
-    :param m: float of the scaling parameter in mm
-    :param lamb: float the TWI threshold
-    :param ksat: float or 2d numpy array of daily hydraulic conductivity in mm/d
-    :param n: float of number of linear reservoirs (n >= 1)
-    :param k: float of detention time of linear reservoirs (k >= 1)
-    :param scale: int value to scale maps to integer format (recommended scale >= 1000)
-    :param trace: boolean to trace back daily maps of variables
-    :param tracevars: string of variables to trace back. Variables must be concatenated by `-`.
-    Example: D-Cp-VSA
-    :param integrate: boolean to integrate back maps of variables
-    :param integratevars: string of variables to integrate back. Variables must be concatenated by `-`.
-    Example: D-Cp-VSA
-    :return: python dict containing:
-
-    {'Series': simulated time series pandas dataframe,
-     'Trace': dict of 3d numpy arrays of traced variables,
-     'Integration': dict of 2d numpy arrays of integrated variables}
-
+    ESMA model simulated variables
+    :return: list of variables names
     """
-    from sys import getsizeof
-
-    # simulation variables
-    simvars = [
+    return [
         "D",  # saturated water stock deficit
         "Vz",  # unsaturated zone water stock
         "Sf",  # surface water stock
@@ -381,314 +680,2836 @@ def simulation(
         "Qs",  # stormflow
         "Q",  # streamflow
     ]
-    #
-    # copy input series
-    df_ts = series_df.copy()
 
-    # compute PET by Oudin model
-    days = df_ts["Date"].dt.dayofyear
-    ts_days = days.values
-    lat = lat * np.pi / 180  # convet lat from degrees to radians
-    df_ts["PET"] = pet_oudin(
-        temperature=df_ts["T"].values, day=ts_days, latitude=lat, k1=c
-    )  # Oudin model
 
-    # append global variables fields to simulation series
-    for v in simvars:
-        if v in ["P", "T", "IRI", "IRA", "PET"]:
-            pass
-        else:
-            df_ts[v] = 0.0  # set as zero
-    #
-    #
-    # get map shape using basin mask
-    shape = np.shape(basin)
-    rows = shape[0]
-    cols = shape[1]
-    tlen = len(df_ts)
-    #
-    # deploy simulation maps
-    mps = dict()
-    mem_size = 0
-    for v in simvars:
-        if v == "Qb" or v == "Qs" or v == "Q":
-            pass
-        else:
-            # store as uint16 (unsigned 16-bit integer)
-            mps[v] = np.zeros(shape=shape, dtype="uint16")
-            mem_size = getsizeof(mps[v]) + mem_size
-    print("Sim size : {} MB".format(mem_size / 1000000))
+def esma_avgvars(scale=1000):
+    """
+    ESMA basin-wide averaged variables
+    :param scale: int value to scale maps
+    :return: dict of variables names and tuple of (multiplier, divisor) of the map average
+    """
+    return {
+        "Cp": (1, scale),
+        "Vz": (1, scale),
+        "Sf": (1, scale),
+        "VSA": (100, 1),  # % of saturated area (maps are not scaled)
+        "Inc": (1, scale),
+        "Evc": (1, scale),
+        "TF": (1, scale),
+        "Tps": (1, scale),
+        "Ins": (1, scale),
+        "R": (1, scale),
+        "RIE": (1, scale),
+        "RSE": (1, scale),
+        "RC": (1, 1),
+        "Inf": (1, scale),
+        "Qv": (1, scale),
+        "Tpv": (1, scale),
+        "Evs": (1, scale),
+        "ET": (1, scale),
+    }
+
+
+def esma_stockvars():
+    """
+    ESMA map stocks (and the saturated area), which are balanced from the fluxes
+    of the previous step, so they are not balanced in the first kernel step.
+    The deficit D is balanced globally (see esma_advance())
+    :return: list of variables names
+    """
+    return ["Cp", "Vz", "Sf", "VSA"]
 
-    # deploy trace and integration maps
-    mps_trace = dict()
-    if trace:
-        tracevars = tracevars.split("-")
-        mem_size = 0
-        for v in tracevars:
-            # store as uint16 (unsigned 16-bit integer)
-            mps_trace[v] = np.zeros(shape=(tlen, rows, cols), dtype="uint16")
-            mem_size = getsizeof(mps_trace[v]) + mem_size
-        print("Trace size : {} MB".format(mem_size / 1000000))
-    mps_integrate = dict()
-    if integrate:
-        integratevars = integratevars.split("-")
-        for v in integratevars:
-            # store as uint16 (unsigned 16-bit integer)
-            mps_integrate[v] = np.zeros(shape=(rows, cols), dtype="uint16")
-    #
-    # get initial local deficits
-    df_ts["D"].values[0] = topmodel_d0(qt0=qt0, qo=qo, m=m)
 
-    # todo adapt to twi vector
-    mps["D"] = scale * topmodel_di(d=df_ts["D"].values[0], twi=htwi, m=m, lamb=lamb)
-    mps["VSA"] = topmodel_vsai(di=mps["D"])
+def esma_meanvars():
+    """
+    ESMA map variables averaged over time in integrated and aggregated maps
+    (the deficit, stocks and the runoff coefficient), while the other variables are summed
+    :return: list of variables names
+    """
+    return ["D"] + esma_stockvars() + ["RC"]
 
-    # get root zone depth:
-    rzd = roots * rho
 
-    # ESMA loop
-    for t in range(tlen):
-        # INPUT define P and PET
-        mps["P"] = df_ts["P"].values[t] * scale * np.ones(shape=shape, dtype="uint32")
-        mps["PET"] = (
-            df_ts["PET"].values[t] * scale * np.ones(shape=shape, dtype="uint32")
-        )
+def esma_graph():
+    """
+    Dependency graph of the ESMA processes. Stocks depend on the fluxes of the
+    previous step, so the stocks balance closes a core of maps always evaluated
+    for the global deficit (see esma_needs()).
+    :return: dict of 'Maps' (dict of map variables and list of maps they are computed from)
+    and 'Series' (dict of global variables and list of global variables they are computed from,
+    while averaged variables are computed from their maps, see esma_avgvars())
+    """
+    maps = {
+        "Cp": ["Inc", "Evc"],
+        "Vz": ["Inf", "Qv", "Tpv"],
+        "Sf": ["Ins", "Inf", "Evs"],
+        "D": [],
+        "VSA": ["D"],
+        "P": [],
+        "PET": ["Evc", "Tps", "Tpv"],
+        "IRI": [],
+        "IRA": [],
+        "Inc": ["Cp"],
+        "Ins": ["Sf", "TF"],
+        "TF": ["Inc"],
+        "R": ["TF", "Ins"],
+        "RIE": ["R", "RSE"],
+        "RSE": ["R", "VSA"],
+        "RC": ["R"],
+        "Inf": ["Sf", "D", "Vz"],
+        "Qv": ["Vz", "D"],
+        "Evc": ["Cp"],
+        "Evs": ["Sf", "Inf", "Tpv"],
+        "Ev": ["Evc", "Evs"],
+        "Tpv": ["Vz", "Qv", "D", "Tps"],
+        "Tps": ["D", "Evc"],
+        "Tp": ["Tps", "Tpv"],
+        "ET": ["Evc", "Evs", "Tps", "Tpv"],
+    }
+    series = {
+        "D": ["Qb", "Tps", "Qv"],
+        "P": [],
+        "PET": [],
+        "IRI": [],
+        "IRA": [],
+        "Qb": ["D"],
+        "Qs": ["R"],
+        "Q": ["Qb", "Qs"],
+        "Tp": ["Tps", "Tpv"],
+        "Ev": ["Evc", "Evs"],
+    }
+    return {"Maps": maps, "Series": series}
+
+
+def esma_optvars():
+    """
+    ESMA map variables that the step kernels may skip (see esma_needs())
+    :return: list of variables names
+    """
+    return ["P", "VSA", "R", "RIE", "RSE", "RC", "Tp", "Ev", "ET"]
 
-        # STOCKS WATER BALANCE (backward looking)
-        if t > 0:
-            # Canopy water balance
-            mps["Cp"] = mps["Cp"] + mps["Inc"] - mps["Evc"]
-            df_ts["Cp"].values[t] = (
-                avg_2d(var2d=mps["Cp"], weight=basin) / scale
-            )  # compute basin-wide avg
-            #
-            # Vadose zone water balance
-            mps["Vz"] = mps["Vz"] + mps["Inf"] - mps["Qv"] - mps["Tpv"]
-            df_ts["Vz"].values[t] = (
-                avg_2d(var2d=mps["Vz"], weight=basin) / scale
-            )  # compute basin-wide avg
-            #
-            # Surface water balance
-            mps["Sf"] = mps["Sf"] + mps["Ins"] - mps["Inf"] - mps["Evs"]
-            df_ts["Sf"].values[t] = (
-                avg_2d(var2d=mps["Sf"], weight=basin) / scale
-            )  # compute basin-wide avg
-            #
-            # Deficit water balance
-            df_ts["D"].values[t] = (
-                df_ts["D"].values[t - 1]
-                + df_ts["Qb"].values[t - 1]
-                + df_ts["Tps"].values[t - 1]
-                - df_ts["Qv"].values[t - 1]
+
+def esma_needs(seriesvars=None, mapvars=None):
+    """
+    Variables to evaluate for the requested outputs, by walking the dependency
+    graph of the ESMA processes (see esma_graph()). The global deficit and its
+    balance are always evaluated.
+    :param seriesvars: None (all variables) or list of requested global variables
+    :param mapvars: list of requested map variables (e.g. traced or integrated)
+    :return: dict of 'Series' and 'Maps' sets of variables to evaluate
+    """
+    graph = esma_graph()
+    avgvars = esma_avgvars()
+    if seriesvars is None:
+        seriesvars = esma_simvars()
+    if mapvars is None:
+        mapvars = []
+    for v in seriesvars:
+        if v not in esma_simvars():
+            raise ValueError(
+                "Variable '{}' not found. Options: {}".format(v, esma_simvars())
             )
-            # update Deficit
-            # todo adapt to twi vector
-            mps["D"] = scale * topmodel_di(
-                d=df_ts["D"].values[t], twi=htwi, m=m, lamb=lamb
+    for v in mapvars:
+        if v not in graph["Maps"]:
+            raise ValueError(
+                "Variable '{}' is not a map variable. Options: {}".format(
+                    v, list(graph["Maps"])
+                )
             )
-            # update VSA
-            mps["VSA"] = topmodel_vsai(di=mps["D"])
-            df_ts["VSA"].values[t] = (
-                100 * avg_2d(var2d=mps["VSA"], weight=basin) / scale
-            )  # compute basin-wide avg
-
-        # FLOWS COMPUTATION
-
-        # --- Canopy flows
-
-        # potential interceptation on canopy
-        p_intc = (scale * cpmax) - mps["Cp"]
-        #
-        # Interceptation in the canopy
-        mps["Inc"] = (p_intc * (mps["P"] > p_intc)) + (mps["P"] * (mps["P"] <= p_intc))
-        df_ts["Inc"].values[t] = (
-            avg_2d(var2d=mps["Inc"], weight=basin) / scale
-        )  # compute basin-wide avg
-        #
-        # Evaporation in the canopy
-        mps["Evc"] = (mps["PET"] * (mps["Cp"] > mps["PET"])) + (
-            mps["Cp"] * (mps["Cp"] <= mps["PET"])
-        )
-        df_ts["Evc"].values[t] = (
-            avg_2d(var2d=mps["Evc"], weight=basin) / scale
-        )  # compute basin-wide avg
-        #
-        # update PET
-        mps["PET"] = mps["PET"] - np.mean(mps["Evc"])
-        #
-        # Throughfall
-        mps["TF"] = mps["P"] - mps["Inc"]
-        df_ts["TF"].values[t] = (
-            avg_2d(var2d=mps["TF"], weight=basin) / scale
-        )  # compute basin-wide avg
-
-        # --- Transpiration from groundwater
+    # walk global variables
+    series = set()
+    stack = list(seriesvars) + ["D"]
+    while len(stack) > 0:
+        v = stack.pop()
+        if v in series:
+            continue
+        series.add(v)
+        stack = stack + graph["Series"].get(v, [])
+    # walk maps
+    maps = set()
+    stack = list(mapvars) + [v for v in series if v in avgvars] + ["D", "PET"]
+    while len(stack) > 0:
+        v = stack.pop()
+        if v in maps:
+            continue
+        maps.add(v)
+        stack = stack + graph["Maps"][v]
+    return {"Series": series, "Maps": maps}
+
+
+def esma_buffers(shape, dtype="float64", avgvars=None):
+    """
+    Deploy the preallocated simulation maps and work buffers of the in-place ESMA step.
+    Maps are views of one stacked block, with the basin-wide averaged variables
+    (see esma_avgvars()) in the first rows, so they are reduced at once (see esma_reduce()).
+    :param shape: tuple of simulation domain shape
+    :param dtype: string code of maps data type. Options: 'float64', 'float32'
+    :param avgvars: None (all) or list of the reduced averaged variables
+    :return: dict of simulation maps and dict of work buffers
+    """
+    if avgvars is None:
+        avgvars = list(esma_avgvars())
+    mapvars = avgvars + [
+        v for v in esma_simvars() if v not in avgvars + ["Qb", "Qs", "Q"]
+    ]
+    block = np.zeros(shape=(len(mapvars),) + tuple(shape), dtype=dtype)
+    mps = dict()
+    for i in range(len(mapvars)):
+        mps[mapvars[i]] = block[i]
+    wrk = {
+        "tmp1": np.zeros(shape=shape, dtype=dtype),
+        "tmp2": np.zeros(shape=shape, dtype=dtype),
+        "mask": np.zeros(shape=shape, dtype="bool"),
+        "active": np.zeros(shape=shape, dtype="bool"),
+        "stack": block[: len(avgvars)].reshape(len(avgvars), -1),
+        "avg": np.zeros(shape=len(avgvars), dtype="float64"),
+    }
+    if dtype != "float64":
+        # reduction blocks (see esma_reduce())
+        cols = min(int(np.prod(shape)), REDUCE_COLS)
+        wrk["stack64"] = np.zeros(shape=(len(avgvars), cols), dtype="float64")
+    return mps, wrk
+
+
+def avg_inplace(var, weight, wsum, tmp):
+    """
+    average raster value based on weight mask using a preallocated buffer (same as avg_2d())
+    :param var: numpy array of values
+    :param weight: numpy array of weight mask
+    :param wsum: float sum of weight mask
+    :param tmp: preallocated numpy array of var shape
+    :return: float average value
+    """
+    np.multiply(var, weight, out=tmp)
+    # sum over the flat view: reducing a 2d array makes a full copy
+    return np.round(np.sum(tmp.ravel()) / wsum, decimals=4)
 
-        # potential tp from gw:
-        p_tpgw = (rzd * scale) - mps["D"]
-        p_tpgw = p_tpgw * (p_tpgw >= 0)  # remove negative values
-        #
-        # Transpiration from groundwater
-        mps["Tps"] = (mps["PET"] * (p_tpgw > mps["PET"])) + (
-            p_tpgw * (p_tpgw <= mps["PET"])
-        )
-        df_ts["Tps"].values[t] = (
-            avg_2d(var2d=mps["Tps"], weight=basin) / scale
-        )  # compute basin-wide avg
 
-        #
-        # update PET
-        mps["PET"] = mps["PET"] - np.mean(mps["Tps"])
+def avg_cells_inplace(var, count, tmp, axis=None):
+    """
+    average value over all simulated cells using a preallocated buffer (same as avg_cells())
+    :param var: numpy array of simulated values
+    :param count: None or numpy array of number of cells per element
+    :param tmp: preallocated numpy array of var shape
+    :param axis: None or int axis of domain units (ensemble members are kept in the other axis)
+    :return: float average value (or numpy array of averages if axis is set)
+    """
+    if axis is not None:
+        if count is None:
+            return np.mean(var, axis=axis, keepdims=True)
+        np.multiply(var, count, out=tmp)
+        return np.sum(tmp, axis=axis, keepdims=True) / np.sum(count)
+    if count is None:
+        return np.mean(var.ravel())
+    np.multiply(var, count, out=tmp)
+    return np.sum(tmp.ravel()) / np.sum(count)
+
+
+def field_uniform(values):
+    """
+    Collapse a field of uniform values to a scalar of the same data type, so it is
+    broadcast lazily only where it meets a spatially varying field
+    :param values: float or numpy array of values
+    :return: scalar (uniform field) or numpy array of values
+    """
+    if np.ndim(values) == 0 or np.size(values) == 0:
+        return values
+    values = np.asarray(values)
+    first = values.flat[0]
+    if np.all(values == first):
+        return first
+    return values
 
-        # ---- Interceptation on the surface
 
-        # potential Infs
-        p_ints = (sfmax * scale) - mps["Sf"]
-        #
-        # Interceptation on the surface
-        mps["Ins"] = (p_ints * (mps["TF"] > p_ints)) + (
-            mps["TF"] * (mps["TF"] <= p_ints)
-        )
-        df_ts["Ins"].values[t] = (
-            avg_2d(var2d=mps["Ins"], weight=basin) / scale
-        )  # compute basin-wide avg
+def field_take(values, ids):
+    """
+    Values of a field at flat cell ids (uniform fields are kept as scalars)
+    :param values: scalar or numpy array of values
+    :param ids: 1d numpy array of flat cell ids
+    :return: scalar or 1d numpy array of values
+    """
+    if np.ndim(values) == 0:
+        return values
+    return np.ravel(values)[ids]
 
-        # ---- Runoff
 
-        # Runoff
-        mps["R"] = mps["TF"] - mps["Ins"]
-        df_ts["R"].values[t] = (
-            avg_2d(var2d=mps["R"], weight=basin) / scale
-        )  # compute basin-wide avg
-        #
-        # Runoff component -  RIE
-        mps["RIE"] = mps["R"] * (mps["VSA"] != 1)
-        df_ts["RIE"].values[t] = (
-            avg_2d(var2d=mps["RIE"], weight=basin) / scale
-        )  # compute basin-wide avg
-        #
-        # Runoff components -  RSE
-        mps["RSE"] = mps["R"] * (mps["VSA"] == 1)
-        df_ts["RSE"].values[t] = (
-            avg_2d(var2d=mps["RSE"], weight=basin) / scale
-        )  # compute basin-wide avg
+def esma_params(
+    htwi,
+    cpmax,
+    sfmax,
+    roots,
+    ksat,
+    rho,
+    m,
+    lamb,
+    count=None,
+    scale=1000,
+    axis=None,
+    dtype="float64",
+    evalvars=None,
+):
+    """
+    Get the scaled parameters of the ESMA step kernels.
+    Arrays are stored in the maps data type so in-place kernels run without casting buffers,
+    and uniform arrays are collapsed to scalars (see field_uniform()).
+    :param htwi: numpy array of HTWI
+    :param cpmax: float or numpy array of canopy water stock capacity in mm
+    :param sfmax: float or numpy array of surface water stock capacity in mm
+    :param roots: float or numpy array of effective root zone depth in mm
+    :param ksat: float or numpy array of daily hydraulic conductivity in mm/d
+    :param rho: float of root zone depth factor
+    :param m: float of the scaling parameter in mm
+    :param lamb: float the TWI threshold
+    :param count: None or numpy array of number of cells per element
+    :param scale: int value to scale maps
+    :param axis: None or int axis of domain units in ensemble runs (see simulation_ensemble())
+    :param dtype: string code of maps data type (see esma_buffers())
+    :param evalvars: None (all) or set of evaluated map variables (see esma_needs()).
+    Kernels skip the optional maps that are not in the set (see esma_optvars()).
+    :return: dict of scaled parameters
+    """
+    # get root zone depth:
+    rzd = roots * rho
+    # the deficit is computed in float64 by all kernels
+    if np.ndim(htwi) > 0:
+        htwi = np.asarray(htwi, dtype="float64")
+    prm = {
+        "cpmax": scale * cpmax,
+        "sfmax": sfmax * scale,
+        "rzd": rzd * scale,
+        "ksat": ksat * scale,
+        "twi": m * (lamb - htwi),
+        "count": count,
+    }
+    for p in prm:
+        if np.ndim(prm[p]) > 0:
+            prm[p] = np.asarray(prm[p], dtype=dtype)
+    for p in ["cpmax", "sfmax", "rzd", "ksat"]:
+        prm[p] = field_uniform(prm[p])
+    # keep the saturation threshold of the deficit in float64
+    if np.ndim(prm["twi"]) > 0:
+        prm["twi"] = np.asarray(prm["twi"], dtype="float64")
+    prm["htwi"] = htwi
+    prm["m"] = m
+    prm["lamb"] = lamb
+    prm["scale"] = scale
+    prm["axis"] = axis
+    if evalvars is None:
+        evalvars = esma_optvars()
+    prm["eval"] = {v: v in evalvars for v in esma_optvars()}
+    return prm
+
+
+def esma_step_inplace(mps, wrk, prm, p, pet, d, t, events=False):
+    """
+    In-place ESMA step kernel. All fluxes are computed within preallocated maps
+    and work buffers, so the steady-state loop performs no array allocations.
+    :param mps: dict of preallocated simulation maps (see esma_buffers())
+    :param wrk: dict of preallocated work buffers (see esma_buffers())
+    :param prm: dict of scaled parameters (see esma_params())
+    :param p: float of scaled precipitation
+    :param pet: float (or numpy array of ensemble members or of cells) of scaled potential evapotranspiration
+    :param d: float (or numpy array of ensemble members) of global deficit in mm
+    :param t: int time step
+    :param events: boolean to compute the canopy and surface flows of dry steps (p = 0)
+    only in the active cells, that hold canopy or surface water (see esma_step_events()).
+    Inactive cells take the same values of the full computation. Branches with many
+    active cells are fully computed (see esma_active()).
+    :return: none
+    """
+    tmp1 = wrk["tmp1"]
+    tmp2 = wrk["tmp2"]
+    mask = wrk["mask"]
+    dry = events and p == 0
+    count = prm["count"]
+    scale = prm["scale"]
+    axis = prm["axis"]
+    evl = prm["eval"]
+
+    # STOCKS WATER BALANCE (backward looking)
+    if t > 0:
+        # Canopy water balance
+        np.add(mps["Cp"], mps["Inc"], out=mps["Cp"])
+        np.subtract(mps["Cp"], mps["Evc"], out=mps["Cp"])
+        # Vadose zone water balance
+        np.add(mps["Vz"], mps["Inf"], out=mps["Vz"])
+        np.subtract(mps["Vz"], mps["Qv"], out=mps["Vz"])
+        np.subtract(mps["Vz"], mps["Tpv"], out=mps["Vz"])
+        # Surface water balance
+        np.add(mps["Sf"], mps["Ins"], out=mps["Sf"])
+        np.subtract(mps["Sf"], mps["Inf"], out=mps["Sf"])
+        np.subtract(mps["Sf"], mps["Evs"], out=mps["Sf"])
+    # update Deficit
+    np.add(prm["twi"], d, out=mps["D"])
+    np.maximum(mps["D"], 0, out=mps["D"])
+    np.multiply(mps["D"], scale, out=mps["D"])
+    # update VSA
+    if evl["VSA"]:
+        np.equal(mps["D"], 0, out=mask)
+        np.copyto(mps["VSA"], mask)
+
+    # --- Canopy flows
+    if evl["P"]:
+        mps["P"].fill(p)
+    ids = None
+    if dry:
+        # active cells hold canopy water
+        np.not_equal(mps["Cp"], 0, out=mask)
+        ids = esma_active(mask=mask)
+    ids_cp = ids
+    if ids is not None:
+        lcl_cp = mps["Cp"].reshape(-1)[ids]
+        # Interceptation in the canopy
+        lcl_inc = np.minimum(field_take(prm["cpmax"], ids) - lcl_cp, p)
+        mps["Inc"].fill(0)
+        mps["Inc"].reshape(-1)[ids] = lcl_inc
+        # Evaporation in the canopy
+        np.minimum(pet, 0, out=mps["Evc"])
+        mps["Evc"].reshape(-1)[ids] = np.minimum(lcl_cp, field_take(pet, ids))
+    else:
+        # Interceptation in the canopy
+        np.subtract(prm["cpmax"], mps["Cp"], out=tmp1)
+        np.minimum(tmp1, p, out=mps["Inc"])
+        # Evaporation in the canopy
+        np.minimum(mps["Cp"], pet, out=mps["Evc"])
+    # update PET
+    pet = pet - avg_cells_inplace(var=mps["Evc"], count=count, tmp=tmp1, axis=axis)
+    # Throughfall
+    np.subtract(p, mps["Inc"], out=mps["TF"])
+
+    # --- Transpiration from groundwater
+    np.subtract(prm["rzd"], mps["D"], out=tmp1)
+    np.maximum(tmp1, 0, out=tmp1)
+    np.minimum(tmp1, pet, out=mps["Tps"])
+    # update PET
+    pet = pet - avg_cells_inplace(var=mps["Tps"], count=count, tmp=tmp1, axis=axis)
+
+    ids = None
+    if dry:
+        # active cells hold surface water or throughfall
+        np.not_equal(mps["Sf"], 0, out=mask)
+        if ids_cp is None:
+            np.not_equal(mps["TF"], 0, out=wrk["active"])
+            np.logical_or(mask, wrk["active"], out=mask)
+        else:
+            # throughfall is zero out of the active cells of the canopy
+            lcl_tf = mps["TF"].reshape(-1)[ids_cp]
+            mask.reshape(-1)[ids_cp[lcl_tf != 0]] = True
+        ids = esma_active(mask=mask)
+    if ids is not None:
+        lcl_sf = mps["Sf"].reshape(-1)[ids]
+        lcl_tf = mps["TF"].reshape(-1)[ids]
+        # ---- Interceptation on the surface
+        lcl_ins = np.minimum(field_take(prm["sfmax"], ids) - lcl_sf, lcl_tf)
+        mps["Ins"].fill(0)
+        mps["Ins"].reshape(-1)[ids] = lcl_ins
+        # ---- Runoff
+        for v in ["R", "RSE", "RIE", "RC"]:
+            if evl[v]:
+                mps[v].fill(0)
+        if evl["R"]:
+            mps["R"].reshape(-1)[ids] = lcl_tf - lcl_ins
+        if evl["RSE"]:
+            lcl_r = mps["R"].reshape(-1)[ids]
+            mps["RSE"].reshape(-1)[ids] = lcl_r * mps["VSA"].reshape(-1)[ids]
+        if evl["RIE"]:
+            lcl_r = mps["R"].reshape(-1)[ids]
+            mps["RIE"].reshape(-1)[ids] = lcl_r - mps["RSE"].reshape(-1)[ids]
+        # ---- Infiltration
+        lcl_infs = np.minimum(lcl_sf, field_take(prm["ksat"], ids))
+        lcl_infu = mps["D"].reshape(-1)[ids] - mps["Vz"].reshape(-1)[ids]
+        mps["Inf"].fill(0)
+        mps["Inf"].reshape(-1)[ids] = np.minimum(lcl_infs, np.maximum(lcl_infu, 0))
+    else:
+        # ---- Interceptation on the surface
+        np.subtract(prm["sfmax"], mps["Sf"], out=tmp1)
+        np.minimum(tmp1, mps["TF"], out=mps["Ins"])
+
+        # ---- Runoff
+        if evl["R"]:
+            np.subtract(mps["TF"], mps["Ins"], out=mps["R"])
+        if evl["RSE"]:
+            np.multiply(mps["R"], mps["VSA"], out=mps["RSE"])
+        if evl["RIE"]:
+            np.subtract(mps["R"], mps["RSE"], out=mps["RIE"])
+        if evl["RC"]:
+            if p > 0:  # avoid division by zero
+                np.multiply(mps["R"], 100, out=mps["RC"])
+                np.divide(mps["RC"], p, out=mps["RC"])
+            else:
+                mps["RC"].fill(0)
+
+        # ---- Infiltration
+        # potential infiltration allowed by surface water
+        np.minimum(mps["Sf"], prm["ksat"], out=tmp1)
+        # potential infiltration allowed by the vadose zone
+        np.subtract(mps["D"], mps["Vz"], out=tmp2)
+        np.maximum(tmp2, 0, out=tmp2)
+        np.minimum(tmp1, tmp2, out=mps["Inf"])
+
+    # ---- Recharge
+    # Vadose zone saturation
+    np.add(mps["D"], scale / 1000, out=tmp2)
+    np.divide(mps["Vz"], tmp2, out=tmp1)
+    np.minimum(tmp1, 1, out=tmp1)
+    # potential recharge
+    np.multiply(tmp1, prm["ksat"], out=tmp1)
+    np.minimum(mps["Vz"], tmp1, out=mps["Qv"])
+
+    # ---- Transpiration from vadose zone
+    # transpiration factor for accounting root depth in the vadoze zone
+    np.divide(prm["rzd"], tmp2, out=tmp2)
+    np.minimum(tmp2, 1, out=tmp2)
+    # potential tp
+    np.subtract(mps["Vz"], mps["Qv"], out=tmp1)
+    np.multiply(tmp1, tmp2, out=tmp2)
+    np.greater(prm["rzd"], mps["D"], out=mask)
+    np.copyto(tmp2, tmp1, where=mask)
+    np.minimum(tmp2, pet, out=mps["Tpv"])
+    # update PET
+    pet = pet - avg_cells_inplace(var=mps["Tpv"], count=count, tmp=tmp1, axis=axis)
+    mps["PET"][...] = pet
+
+    # ---- Evaporation from the surface
+    if ids is not None:
+        # active cells of the surface
+        np.minimum(pet, 0, out=mps["Evs"])
+        lcl_sf = mps["Sf"].reshape(-1)[ids] - mps["Inf"].reshape(-1)[ids]
+        mps["Evs"].reshape(-1)[ids] = np.minimum(lcl_sf, field_take(pet, ids))
+    else:
+        np.subtract(mps["Sf"], mps["Inf"], out=tmp1)
+        np.minimum(tmp1, pet, out=mps["Evs"])
+
+    # --- ET
+    if evl["Tp"]:
+        np.add(mps["Tps"], mps["Tpv"], out=mps["Tp"])
+    if evl["Ev"]:
+        np.add(mps["Evc"], mps["Evs"], out=mps["Ev"])
+    if evl["ET"]:
+        np.add(mps["Evc"], mps["Evs"], out=mps["ET"])
+        np.add(mps["ET"], mps["Tps"], out=mps["ET"])
+        np.add(mps["ET"], mps["Tpv"], out=mps["ET"])
+
+
+def esma_active(mask, ratio=None):
+    """
+    Flat ids of the active cells of a branch, when they are few enough to skip the
+    inactive cells (gathering active cells costs more than a full pass over many cells)
+    :param mask: numpy array of booleans of active cells
+    :param ratio: None (EVENTS_RATIO) or float of max fraction of active cells
+    :return: None (full pass) or 1d numpy array of flat ids of active cells
+    """
+    if ratio is None:
+        ratio = EVENTS_RATIO
+    if np.count_nonzero(mask) > ratio * mask.size:
+        return None
+    return np.flatnonzero(mask)
+
+
+def esma_step_events(mps, wrk, prm, p, pet, d, t):
+    """
+    Event-driven in-place ESMA step kernel. In dry steps (no precipitation) the canopy
+    and surface flows are computed only in the active cells, that hold canopy or surface
+    water (see esma_step_inplace()). Activity is rebuilt at every step from the stocks,
+    and results are identical to the 'inplace' kernel (see esma_backends_check()).
+    :param mps: dict of preallocated simulation maps (see esma_buffers())
+    :param wrk: dict of preallocated work buffers (see esma_buffers())
+    :param prm: dict of scaled parameters (see esma_params())
+    :param p: float of scaled precipitation
+    :param pet: float (or numpy array of cells) of scaled potential evapotranspiration
+    :param d: float of global deficit in mm
+    :param t: int time step
+    :return: none
+    """
+    esma_step_inplace(mps=mps, wrk=wrk, prm=prm, p=p, pet=pet, d=d, t=t, events=True)
+
+
+def esma_step_numpy(mps, wrk, prm, p, pet, d, t):
+    """
+    Reference NumPy ESMA step kernel. Maps are recomputed as new arrays on every step.
+    Uniform P and PET are kept as scalars and only broadcast against the maps.
+    :param mps: dict of simulation maps (see esma_buffers())
+    :param wrk: dict of work buffers (not used)
+    :param prm: dict of scaled parameters (see esma_params())
+    :param p: float of scaled precipitation
+    :param pet: float (or numpy array of cells) of scaled potential evapotranspiration
+    :param d: float of global deficit in mm
+    :param t: int time step
+    :return: none
+    """
+    shape = np.shape(mps["D"])
+    count = prm["count"]
+    scale = prm["scale"]
+    evl = prm["eval"]
+
+    # INPUT define P and PET (scalars or cells arrays)
+    pet = np.asarray(pet, dtype="float64")
+
+    # STOCKS WATER BALANCE (backward looking)
+    if t > 0:
+        # Canopy water balance
+        mps["Cp"] = mps["Cp"] + mps["Inc"] - mps["Evc"]
+        #
+        # Vadose zone water balance
+        mps["Vz"] = mps["Vz"] + mps["Inf"] - mps["Qv"] - mps["Tpv"]
         #
-        # Runoff components -  RC
-        if df_ts["P"].values[t] > 0:  # avoid division by zero
-            mps["RC"] = 100 * mps["R"] / mps["P"]
+        # Surface water balance
+        mps["Sf"] = mps["Sf"] + mps["Ins"] - mps["Inf"] - mps["Evs"]
+    #
+    # update Deficit
+    mps["D"] = scale * topmodel_di(d=d, twi=prm["htwi"], m=prm["m"], lamb=prm["lamb"])
+    # update VSA
+    if evl["VSA"]:
+        mps["VSA"] = topmodel_vsai(di=mps["D"])
+
+    # FLOWS COMPUTATION
+
+    # --- Canopy flows
+
+    # potential interceptation on canopy
+    p_intc = prm["cpmax"] - mps["Cp"]
+    #
+    # Interceptation in the canopy
+    mps["Inc"] = (p_intc * (p > p_intc)) + (p * (p <= p_intc))
+    #
+    # Evaporation in the canopy
+    mps["Evc"] = (pet * (mps["Cp"] > pet)) + (mps["Cp"] * (mps["Cp"] <= pet))
+    #
+    # update PET
+    pet = pet - avg_cells(var=mps["Evc"], count=count)
+    #
+    # Throughfall
+    mps["TF"] = p - mps["Inc"]
+
+    # --- Transpiration from groundwater
+
+    # potential tp from gw:
+    p_tpgw = prm["rzd"] - mps["D"]
+    p_tpgw = p_tpgw * (p_tpgw >= 0)  # remove negative values
+    #
+    # Transpiration from groundwater
+    mps["Tps"] = (pet * (p_tpgw > pet)) + (p_tpgw * (p_tpgw <= pet))
+    #
+    # update PET
+    pet = pet - avg_cells(var=mps["Tps"], count=count)
+
+    # ---- Interceptation on the surface
+
+    # potential Infs
+    p_ints = prm["sfmax"] - mps["Sf"]
+    #
+    # Interceptation on the surface
+    mps["Ins"] = (p_ints * (mps["TF"] > p_ints)) + (mps["TF"] * (mps["TF"] <= p_ints))
+
+    # ---- Runoff
+
+    # Runoff
+    if evl["R"]:
+        mps["R"] = mps["TF"] - mps["Ins"]
+    #
+    # Runoff component -  RIE
+    if evl["RIE"]:
+        mps["RIE"] = mps["R"] * (mps["VSA"] != 1)
+    #
+    # Runoff components -  RSE
+    if evl["RSE"]:
+        mps["RSE"] = mps["R"] * (mps["VSA"] == 1)
+    #
+    # Runoff components -  RC
+    if evl["RC"]:
+        if p > 0:  # avoid division by zero
+            mps["RC"] = 100 * mps["R"] / p
         else:
             mps["RC"] = mps["RC"] * 0
-        df_ts["RC"].values[t] = avg_2d(
-            var2d=mps["RC"], weight=basin
-        )  # compute basin-wide avg
 
-        # ---- Infiltration
-        # potential infiltration allowed by surface water
-        p_infs = ((ksat * scale) * (mps["Sf"] > (ksat * scale))) + (
-            mps["Sf"] * (mps["Sf"] <= (ksat * scale))
-        )
-        #
-        # potential infiltration allowed by the vadose zone
-        p_infu = (mps["D"] - mps["Vz"]) * (
-            (mps["D"] - mps["Vz"]) > 0
-        )  # ensure positive values only - Deficit update
-        #
-        # Infiltration
-        mps["Inf"] = (p_infu * (p_infs > p_infu)) + (p_infs * (p_infs <= p_infu))
-        df_ts["Inf"].values[t] = (
-            avg_2d(var2d=mps["Inf"], weight=basin) / scale
-        )  # compute basin-wide avg
+    # ---- Infiltration
+    # potential infiltration allowed by surface water
+    p_infs = (prm["ksat"] * (mps["Sf"] > prm["ksat"])) + (
+        mps["Sf"] * (mps["Sf"] <= prm["ksat"])
+    )
+    #
+    # potential infiltration allowed by the vadose zone
+    p_infu = (mps["D"] - mps["Vz"]) * (
+        (mps["D"] - mps["Vz"]) > 0
+    )  # ensure positive values only - Deficit update
+    #
+    # Infiltration
+    mps["Inf"] = (p_infu * (p_infs > p_infu)) + (p_infs * (p_infs <= p_infu))
+
+    # ---- Recharge
+
+    # Vadose zone saturation
+    unz_sat = mps["Vz"] / (mps["D"] + (scale / 1000))
+    unz_sat = np.nan_to_num(unz_sat, nan=0)
+    unz_sat = (unz_sat * (unz_sat <= 1)) + (1 * (unz_sat > 1))
+    #
+    # potential recharge
+    p_qv = prm["ksat"] * unz_sat
+    #
+    # Recharge
+    mps["Qv"] = (p_qv * (mps["Vz"] > p_qv)) + (mps["Vz"] * (mps["Vz"] <= p_qv))
+
+    # ---- Transpiration from vadose zone
+    #
+    # transpiration factor for accounting root depth in the vadoze zone
+    tp_factor = prm["rzd"] / (mps["D"] + (scale / 1000))
+    tp_factor = np.nan_to_num(
+        tp_factor, nan=1, posinf=1
+    )  # avoid nan values where D is 0
+    tp_factor = (tp_factor * (tp_factor < 1)) + (1 * (tp_factor >= 1))
+    #
+    # potential tp
+    p_tpun_1 = mps["Vz"] - mps["Qv"]
+    p_tpun = (p_tpun_1 * (prm["rzd"] > mps["D"])) + (
+        p_tpun_1 * tp_factor * (prm["rzd"] <= mps["D"])
+    )
+    #
+    # Transpiration from vadose zone
+    mps["Tpv"] = (pet * (p_tpun > pet)) + (p_tpun * (p_tpun <= pet))
+    #
+    # update PET
+    pet = pet - avg_cells(var=mps["Tpv"], count=count)
+
+    # Evaporation from the surface
+    # potential Evs
+    p_evs = mps["Sf"] - mps["Inf"]
+    # Evs
+    mps["Evs"] = (pet * (p_evs > pet)) + (p_evs * (p_evs <= pet))
+
+    # output maps of P and PET (read-only views of uniform values)
+    if evl["P"]:
+        mps["P"] = np.broadcast_to(np.float64(p), shape)
+    mps["PET"] = np.broadcast_to(pet, shape)
+
+    # --- ET
+    if evl["Tp"]:
+        mps["Tp"] = mps["Tps"] + mps["Tpv"]  # Tp
+    if evl["Ev"]:
+        mps["Ev"] = mps["Evc"] + mps["Evs"]  # Ev
+    if evl["ET"]:
+        mps["ET"] = mps["Evc"] + mps["Evs"] + mps["Tps"] + mps["Tpv"]
+
+
+def esma_cells(
+    cp,
+    vz,
+    sf,
+    d,
+    vsa,
+    pp,
+    ppet,
+    inc,
+    evc,
+    tf,
+    ins,
+    r,
+    rie,
+    rse,
+    rc,
+    inf,
+    qv,
+    tps,
+    tpv,
+    evs,
+    tp,
+    ev,
+    et,
+    ptpv,
+    evl,
+    cpmax,
+    sfmax,
+    rzd,
+    ksat,
+    twi,
+    count,
+    p,
+    dg,
+    t,
+    scale,
+):
+    """
+    Per-cell ESMA step kernel over flat arrays (see esma_step_jit()).
+    Fluxes are fused in one pass per cell. Only the domain-wide PET abstractions
+    (Evc, Tps and Tpv) need an extra reduction pass each.
+    :param cp ... et: 1d numpy arrays of simulation maps (see esma_buffers()).
+    ppet holds the scaled potential evapotranspiration of cells when called.
+    :param ptpv: 1d numpy array buffer of potential transpiration from the vadose zone
+    :param evl: tuple of booleans of evaluated optional maps (see esma_optvars())
+    :param cpmax ... count: 1d numpy arrays of scaled parameters (see esma_params())
+    :param p: float of scaled precipitation
+    :param dg: float of global deficit in mm
+    :param t: int time step
+    :param scale: float value to scale maps
+    :return: none
+    """
+    size = len(cp)
+    thr = scale / 1000
+    # optional maps
+    e_p, e_vsa, e_r, e_rie, e_rse, e_rc, e_tp, e_ev, e_et = evl
+    cnt = 0.0
+    sum_evc = 0.0
+    # --- pass 1: stocks, deficit, canopy, surface, infiltration and recharge
+    for i in range(size):
+        # STOCKS WATER BALANCE (backward looking)
+        if t > 0:
+            cp[i] = cp[i] + inc[i] - evc[i]
+            vz[i] = vz[i] + inf[i] - qv[i] - tpv[i]
+            sf[i] = sf[i] + ins[i] - inf[i] - evs[i]
+        # update Deficit and VSA
+        d[i] = max(twi[i] + dg, 0.0) * scale
+        if e_vsa:
+            vsa[i] = 1.0 if d[i] == 0 else 0.0
+        # Canopy flows
+        if e_p:
+            pp[i] = p
+        inc[i] = min(cpmax[i] - cp[i], p)
+        evc[i] = min(cp[i], ppet[i])
+        tf[i] = p - inc[i]
+        # Interceptation on the surface
+        ins[i] = min(sfmax[i] - sf[i], tf[i])
+        # Runoff
+        if e_r:
+            r[i] = tf[i] - ins[i]
+        if e_rse:
+            rse[i] = r[i] * vsa[i]
+        if e_rie:
+            rie[i] = r[i] - rse[i]
+        if e_rc:
+            rc[i] = 100 * r[i] / p if p > 0 else 0.0
+        # Infiltration
+        inf[i] = min(min(sf[i], ksat[i]), max(d[i] - vz[i], 0.0))
+        # Recharge
+        qv[i] = min(vz[i], ksat[i] * min(vz[i] / (d[i] + thr), 1.0))
+        # potential transpiration from the vadose zone
+        ptpv[i] = vz[i] - qv[i]
+        if rzd[i] <= d[i]:
+            ptpv[i] = ptpv[i] * min(rzd[i] / (d[i] + thr), 1.0)
+        # domain-wide Evc
+        cnt = cnt + count[i]
+        sum_evc = sum_evc + evc[i] * count[i]
+    # --- pass 2: transpiration from groundwater
+    avg_evc = sum_evc / cnt
+    sum_tps = 0.0
+    for i in range(size):
+        ppet[i] = ppet[i] - avg_evc
+        tps[i] = min(max(rzd[i] - d[i], 0.0), ppet[i])
+        sum_tps = sum_tps + tps[i] * count[i]
+    # --- pass 3: transpiration from the vadose zone
+    avg_tps = sum_tps / cnt
+    sum_tpv = 0.0
+    for i in range(size):
+        ppet[i] = ppet[i] - avg_tps
+        tpv[i] = min(ptpv[i], ppet[i])
+        sum_tpv = sum_tpv + tpv[i] * count[i]
+    # --- pass 4: evaporation from the surface and ET
+    avg_tpv = sum_tpv / cnt
+    for i in range(size):
+        ppet[i] = ppet[i] - avg_tpv
+        evs[i] = min(sf[i] - inf[i], ppet[i])
+        if e_tp:
+            tp[i] = tps[i] + tpv[i]
+        if e_ev:
+            ev[i] = evc[i] + evs[i]
+        if e_et:
+            et[i] = (evc[i] + evs[i]) + (tps[i] + tpv[i])
+
+
+def esma_jit():
+    """
+    Get the JIT compiled per-cell ESMA kernel (requires numba)
+    :return: compiled esma_cells() function
+    """
+    if "cells" not in _esma_jit_cache:
+        import numba
+
+        _esma_jit_cache["cells"] = numba.njit(cache=True)(esma_cells)
+    return _esma_jit_cache["cells"]
+
+
+def esma_step_jit(mps, wrk, prm, p, pet, d, t):
+    """
+    JIT compiled ESMA step kernel (requires numba). Runs esma_cells() over flat
+    views of the simulation maps, so it needs the buffers of esma_buffers().
+    :param mps: dict of preallocated simulation maps (see esma_buffers())
+    :param wrk: dict of preallocated work buffers (see esma_buffers())
+    :param prm: dict of scaled parameters (see esma_params())
+    :param p: float of scaled precipitation
+    :param pet: float (or numpy array of cells) of scaled potential evapotranspiration
+    :param d: float of global deficit in mm
+    :param t: int time step
+    :return: none
+    """
+    shape = np.shape(mps["D"])
+    # broadcast parameters to flat arrays once
+    if "cells" not in prm:
+        prm["cells"] = dict()
+        size = int(np.prod(shape))
+        for v in ["cpmax", "sfmax", "rzd", "ksat", "twi", "count"]:
+            if prm[v] is None:
+                lcl_value = 1.0
+            else:
+                lcl_value = prm[v]
+            lcl_dtype = mps["D"].dtype
+            if v == "twi":
+                lcl_dtype = "float64"  # saturation threshold (see esma_params())
+            lcl_value = np.asarray(lcl_value, dtype=lcl_dtype)
+            if np.ndim(lcl_value) == 0:
+                # uniform values are read from a zero-stride view (no copy)
+                lcl_value = np.broadcast_to(lcl_value, (size,))
+            else:
+                lcl_value = np.ascontiguousarray(np.broadcast_to(lcl_value, shape))
+            prm["cells"][v] = lcl_value.reshape(-1)
+        prm["cells"]["eval"] = tuple([prm["eval"][v] for v in esma_optvars()])
+    fp = prm["cells"]
+    fm = {v: mps[v].reshape(-1) for v in mps}
+    # scalar or distributed PET
+    mps["PET"][...] = pet
+    esma_jit()(
+        fm["Cp"],
+        fm["Vz"],
+        fm["Sf"],
+        fm["D"],
+        fm["VSA"],
+        fm["P"],
+        fm["PET"],
+        fm["Inc"],
+        fm["Evc"],
+        fm["TF"],
+        fm["Ins"],
+        fm["R"],
+        fm["RIE"],
+        fm["RSE"],
+        fm["RC"],
+        fm["Inf"],
+        fm["Qv"],
+        fm["Tps"],
+        fm["Tpv"],
+        fm["Evs"],
+        fm["Tp"],
+        fm["Ev"],
+        fm["ET"],
+        wrk["tmp1"].reshape(-1),
+        fp["eval"],
+        fp["cpmax"],
+        fp["sfmax"],
+        fp["rzd"],
+        fp["ksat"],
+        fp["twi"],
+        fp["count"],
+        float(p),
+        float(d),
+        int(t),
+        float(prm["scale"]),
+    )
+
+
+def esma_backends():
+    """
+    ESMA step kernels available to the simulation loop.
+    Every kernel has the same signature: kernel(mps, wrk, prm, p, pet, d, t)
+    :return: dict of backend names and step kernel functions
+    """
+    return {
+        "numpy": esma_step_numpy,  # reference kernel
+        "inplace": esma_step_inplace,
+        "events": esma_step_events,
+        "jit": esma_step_jit,
+    }
+
+
+def esma_backends_check(
+    series_df, backends="inplace-jit", tol=0.001, reference="numpy", **kwargs
+):
+    """
+    Check ESMA backends against a reference backend in a golden run.
+    Use tol=0 to check identical results (e.g. 'events' against 'inplace').
+    :param series_df: pandas dataframe of timeseries (see simulation())
+    :param backends: string of backends to check. Backends must be concatenated by `-`.
+    :param tol: float of max absolute difference in mm allowed in the series
+    :param reference: string of the reference backend
+    :param kwargs: simulation() parameters of the golden run
+    :return: python dict containing:
+
+    {'<backend>': {'Max Diff': float max absolute difference in the series,
+                   'OK Flag': boolean, True if the backend agrees with the reference}}
+
+    """
+    kwargs["backend"] = reference
+    ref = simulation(series_df=series_df, **kwargs)["Series"]
+    simvars = [v for v in esma_simvars() if v in ref.columns]
+    dct = dict()
+    for b in backends.split("-"):
+        kwargs["backend"] = b
+        sim = simulation(series_df=series_df, **kwargs)["Series"]
+        lcl_diff = np.max(np.abs(sim[simvars].values - ref[simvars].values))
+        dct[b] = {"Max Diff": lcl_diff, "OK Flag": bool(lcl_diff <= tol)}
+    return dct
+
+
+def esma_series(series_df, avgvars=None, seriesvars=None):
+    """
+    Deploy the global series of the ESMA loop in one preallocated block of
+    contiguous rows, with the basin-wide averaged variables (see esma_avgvars())
+    in the first rows, so the reduction of a step is written at once (see esma_reduce()).
+    Input fields that are not simulated (e.g. Date and T) are copied once to arrays,
+    so the outputs do not share memory with series_df.
+    :param series_df: pandas dataframe of timeseries
+    :param avgvars: None (all) or list of the reduced averaged variables
+    :param seriesvars: None (all) or set of evaluated global variables (see esma_needs())
+    :return: python dict of 1d numpy arrays of fields (views of the 'Block' rows), plus the
+    'Block' 2d numpy array, the 'Fields' list of fields and the 'Index' of the series
+    """
+    simvars = esma_simvars()
+    if avgvars is None:
+        avgvars = list(esma_avgvars())
+    if seriesvars is None:
+        seriesvars = simvars
+    # fields of the input series come first
+    fields = list(series_df.columns)
+    if "PET" not in fields:
+        fields.append("PET")
+    for v in simvars:
+        if v not in fields and v not in ["P", "T", "IRI", "IRA"] and v in seriesvars:
+            fields.append(v)
+    blockvars = avgvars + [v for v in fields if v in simvars and v not in avgvars]
+    block = np.zeros(shape=(len(blockvars), len(series_df)), dtype="float64")
+    ser = {"Block": block, "Fields": fields, "Index": series_df.index}
+    for i in range(len(blockvars)):
+        ser[blockvars[i]] = block[i]
+    for v in fields:
+        if v not in blockvars:
+            ser[v] = series_df[v].to_numpy(copy=True)
+        elif v in ["P", "IRI", "IRA"]:
+            ser[v][...] = series_df[v].values
+    return ser
+
+
+def esma_frame(ser):
+    """
+    Build the series dataframe of the ESMA loop once, with no copy of the block rows
+    :param ser: python dict of the simulation series (see esma_series())
+    :return: pandas dataframe of timeseries
+    """
+    import pandas as pd
+
+    return pd.DataFrame(
+        {v: ser[v] for v in ser["Fields"]}, index=ser["Index"], copy=False
+    )
+
+
+def esma_setup(
+    series_df,
+    basin,
+    htwi,
+    qt0,
+    cpmax,
+    sfmax,
+    roots,
+    qo,
+    m,
+    lamb,
+    ksat,
+    rho,
+    c,
+    scale=1000,
+    lat=-30,
+    mode="grid",
+    hru_bins=100,
+    backend="numpy",
+    state0=None,
+    pet_field=None,
+    precision="packed",
+    needs=None,
+):
+    """
+    Deploy the simulation series, domain, maps and step kernel of the ESMA loop
+    (see simulation() for the parameters)
+    :param needs: None (all) or dict of variables to evaluate (see esma_needs())
+    :return: python dict of the simulation setup (advance it with esma_advance())
+    """
+    from sys import getsizeof
+
+    if mode not in ["grid", "active", "hru"]:
+        raise ValueError(
+            "Mode '{}' not found. Options: ['grid', 'active', 'hru']".format(mode)
+        )
+    # maps precision
+    dtype = "float64"
+    if precision == "float32":
+        if backend == "numpy":
+            raise ValueError("Precision 'float32' needs the 'inplace' or 'jit' backend")
+        # native maps in mm
+        scale = 1
+        dtype = "float32"
+    elif precision != "packed":
+        raise ValueError(
+            "Precision '{}' not found. Options: ['packed', 'float32']".format(precision)
+        )
+    #
+    # reduced and evaluated variables
+    avgvars = esma_avgvars(scale=scale)
+    evalvars = None
+    seriesvars = None
+    if needs is not None:
+        avgvars = {v: avgvars[v] for v in avgvars if v in needs["Series"]}
+        evalvars = needs["Maps"]
+        seriesvars = needs["Series"]
+    #
+    # deploy simulation series
+    ser = esma_series(series_df=series_df, avgvars=list(avgvars), seriesvars=seriesvars)
+
+    # compute PET by Oudin model
+    ts_days = series_df["Date"].dt.dayofyear.values
+    lat = lat * np.pi / 180  # convet lat from degrees to radians
+    ser["PET"][...] = pet_oudin(
+        temperature=ser["T"], day=ts_days, latitude=lat, k1=c
+    )  # Oudin model
+    #
+    # deploy simulation domain
+    dom = None
+    count = None
+    if mode == "hru":
+        dom = hru_domain(
+            basin=basin,
+            htwi=htwi,
+            cpmax=cpmax,
+            sfmax=sfmax,
+            roots=roots,
+            ksat=ksat,
+            bins=hru_bins,
+        )
+    elif mode == "active":
+        dom = active_domain(
+            basin=basin, htwi=htwi, cpmax=cpmax, sfmax=sfmax, roots=roots, ksat=ksat
+        )
+    if mode != "grid":
+        basin = dom["Weight"]
+        htwi = dom["HTWI"]
+        count = dom["Count"]
+        cpmax = dom["cpmax"]
+        sfmax = dom["sfmax"]
+        roots = dom["roots"]
+        ksat = dom["ksat"]
+        print("Domain size : {} units".format(len(basin)))
+    #
+    # deploy simulation maps
+    mps, wrk = esma_buffers(shape=np.shape(basin), dtype=dtype, avgvars=list(avgvars))
+    mem_size = 0
+    for v in mps:
+        mem_size = getsizeof(mps[v]) + mem_size
+    print("Sim size : {} MB".format(mem_size / 1000000))
+    #
+    offset = 0
+    if state0 is None:
+        # get initial global deficit
+        ser["D"][0] = topmodel_d0(qt0=qt0, qo=qo, m=m)
+    else:
+        # warm start: the first step is the day after the saved state
+        offset = 1
+        lcl_date = np.datetime64(state0["Date"], "D") + 1
+        if np.datetime64(ser["Date"][0], "D") != lcl_date:
+            raise ValueError(
+                "Series must start in the day after the state date: {}".format(lcl_date)
+            )
+        ser["D"][0] = state0["D"] + state0["Qb"] + state0["Tps"] - state0["Qv"]
+        for v in state0["Maps"]:
+            lcl_map = state0["Maps"][v] * (scale / state0["scale"])
+            if dom is None:
+                mps[v][...] = lcl_map
+            elif count is None:
+                mask = dom["Map"] >= 0
+                mps[v][dom["Map"][mask]] = lcl_map[mask]
+            else:
+                # average cells of each unit
+                mask = dom["Map"] >= 0
+                mps[v][...] = (
+                    np.bincount(
+                        dom["Map"][mask], weights=lcl_map[mask], minlength=len(count)
+                    )
+                    / count
+                )
+
+    # scaled parameters of the ESMA step
+    prm = esma_params(
+        htwi=htwi,
+        cpmax=cpmax,
+        sfmax=sfmax,
+        roots=roots,
+        ksat=ksat,
+        rho=rho,
+        m=m,
+        lamb=lamb,
+        count=count,
+        scale=scale,
+        dtype=dtype,
+        evalvars=evalvars,
+    )
+
+    # distributed PET buffers
+    pet_fld = None
+    if pet_field is not None:
+        pet_fld = {
+            "Field": pet_field,
+            "Days": ts_days,
+            "c": c,
+            "Grid": np.zeros(shape=np.shape(pet_field["Bands"]), dtype="float64"),
+            "Cells": None,
+        }
+        if dom is not None:
+            pet_fld["Mask"] = dom["Map"] >= 0
+            pet_fld["Cells"] = np.zeros(shape=np.shape(basin), dtype="float64")
+
+    # basin-wide reduction stage
+    rdc = {
+        "Weights": np.ravel(basin).astype("float64") / np.sum(basin, dtype="float64"),
+        "Multipliers": np.array([avgvars[v][0] for v in avgvars], dtype="float64"),
+        "Divisors": np.array([avgvars[v][1] for v in avgvars], dtype="float64"),
+        "Stocks": np.isin(list(avgvars), esma_stockvars()),
+        # series rows of the averaged variables (see esma_series())
+        "Averages": ser["Block"][: len(avgvars)].T,
+        # the numpy kernel replaces the maps, so they are copied to the stack
+        "Copy": backend == "numpy",
+    }
+
+    # select ESMA step kernel
+    backends = esma_backends()
+    if backend not in backends:
+        raise ValueError(
+            "Backend '{}' not found. Options: {}".format(backend, list(backends))
+        )
+    return {
+        "Series": ser,
+        "Maps": mps,
+        "Work": wrk,
+        "Params": prm,
+        "Domain": dom,
+        "Weight": basin,
+        "WSum": np.sum(basin),
+        "Step": backends[backend],
+        "AvgVars": avgvars,
+        "Reduce": rdc,
+        "qo": qo,
+        "m": m,
+        "scale": scale,
+        "Offset": offset,
+        "PETField": pet_fld,
+        "Precision": precision,
+        "Needs": needs,
+    }
+
+
+def esma_memory(sim):
+    """
+    Memory accounting of the simulation setup
+    :param sim: python dict of the simulation setup (see esma_setup())
+    :return: dict of bytes of simulation maps, work buffers and parameter arrays
+    """
+    dct = {
+        "Maps": sum([sim["Maps"][v].nbytes for v in sim["Maps"]]),
+        # the stack is a view of the maps
+        "Work": sum([sim["Work"][v].nbytes for v in sim["Work"] if v != "stack"]),
+        "Params": 0,
+    }
+    prm = sim["Params"]
+    for p in ["cpmax", "sfmax", "rzd", "ksat", "twi", "count"]:
+        dct["Params"] = dct["Params"] + np.asarray(prm[p]).nbytes
+    if sim["PETField"] is not None:
+        dct["Work"] = dct["Work"] + sim["PETField"]["Grid"].nbytes
+        if sim["PETField"]["Cells"] is not None:
+            dct["Work"] = dct["Work"] + sim["PETField"]["Cells"].nbytes
+    return dct
+
+
+def esma_advance(sim, t):
+    """
+    Advance the ESMA loop by one time step
+    :param sim: python dict of the simulation setup (see esma_setup())
+    :param t: int time step
+    :return: none
+    """
+    ser = sim["Series"]
+    mps = sim["Maps"]
+    scale = sim["scale"]
+    # kernel time step (warm starts have a previous step)
+    tk = t + sim["Offset"]
+    # Deficit water balance (backward looking)
+    if t > 0:
+        ser["D"][t] = (
+            ser["D"][t - 1] + ser["Qb"][t - 1] + ser["Tps"][t - 1] - ser["Qv"][t - 1]
+        )
+    #
+    # distributed PET
+    pet = ser["PET"][t] * scale
+    fld = sim["PETField"]
+    if fld is not None:
+        pet = pet_oudin_field(
+            field=fld["Field"],
+            temperature=ser["T"][t],
+            day=fld["Days"][t],
+            out=fld["Grid"],
+            k1=fld["c"],
+        )
+        dom = sim["Domain"]
+        if dom is not None:
+            if dom["Count"] is None:
+                np.compress(fld["Mask"].ravel(), pet.ravel(), out=fld["Cells"])
+            else:
+                # average cells of each unit
+                fld["Cells"][...] = (
+                    np.bincount(
+                        dom["Map"][fld["Mask"]],
+                        weights=pet[fld["Mask"]],
+                        minlength=len(dom["Count"]),
+                    )
+                    / dom["Count"]
+                )
+            pet = fld["Cells"]
+        # not rounded, so a uniform field matches the lumped PET up to float roundoff
+        ser["PET"][t] = np.dot(np.ravel(pet), sim["Reduce"]["Weights"])
+        np.multiply(pet, scale, out=pet)
+    #
+    # compute maps
+    sim["Step"](
+        mps=mps,
+        wrk=sim["Work"],
+        prm=sim["Params"],
+        p=ser["P"][t] * scale,
+        pet=pet,
+        d=ser["D"][t],
+        t=tk,
+    )
+    #
+    # compute basin-wide averages
+    esma_reduce(sim=sim, t=t, first=tk == 0)
+    #
+    # --- Baseflow
+    ser["Qb"][t] = topmodel_qb(d=ser["D"][t], qo=sim["qo"], m=sim["m"])
+
+
+def esma_reduce(sim, t, first=False):
+    """
+    Basin-wide averages of all averaged variables of a time step in one weighted
+    matrix-vector product over the stacked maps (see esma_buffers()). Averages are
+    stored in place in the simulation series (see esma_series()).
+    :param sim: python dict of the simulation setup (see esma_setup())
+    :param t: int time step
+    :param first: boolean to first kernel step (stocks are not balanced)
+    :return: none
+    """
+    rdc = sim["Reduce"]
+    wrk = sim["Work"]
+    if rdc["Copy"]:
+        i = 0
+        for v in sim["AvgVars"]:
+            np.copyto(wrk["stack"][i], np.ravel(sim["Maps"][v]))
+            i = i + 1
+    if "stack64" not in wrk:
+        np.dot(wrk["stack"], rdc["Weights"], out=wrk["avg"])
+    else:
+        # float32 maps are reduced in float64 blocks of columns
+        wrk["avg"][...] = 0.0
+        weights = rdc["Weights"]
+        cols = np.shape(wrk["stack64"])[1]
+        for j in range(0, len(weights), cols):
+            lcl_weights = weights[j : j + cols]
+            lcl_block = wrk["stack64"][:, : len(lcl_weights)]
+            np.copyto(lcl_block, wrk["stack"][:, j : j + cols])
+            wrk["avg"] += np.dot(lcl_block, lcl_weights)
+    avg = rdc["Averages"][t]
+    # the array method rounds with no allocation (unlike the np.round() wrapper)
+    wrk["avg"].round(decimals=4, out=avg)
+    np.multiply(avg, rdc["Multipliers"], out=avg)
+    np.divide(avg, rdc["Divisors"], out=avg)
+    if first:
+        avg[rdc["Stocks"]] = 0.0  # stocks are not balanced in the first step
+
+
+def esma_state(sim, t):
+    """
+    Get the simulation state at the end of a time step (for warm starts)
+    :param sim: python dict of the simulation setup (see esma_setup())
+    :param t: int time step
+    :return: python dict containing:
+
+    {'Date': date of time step,
+     'D', 'Qb', 'Tps', 'Qv': float global variables of time step,
+     'Maps': dict of 2d numpy arrays of stocks and fluxes of the stocks balance (scaled),
+     'scale': int value to scale maps,
+     'Qs': 1d numpy array of pending routed runoff (set by simulation())}
+
+    """
+    ser = sim["Series"]
+    dom = sim["Domain"]
+    dct = {"Date": ser["Date"][t], "scale": sim["scale"], "Qs": None}
+    for v in ["D", "Qb", "Tps", "Qv"]:
+        dct[v] = ser[v][t]
+    dct["Maps"] = dict()
+    for v in ["Cp", "Vz", "Sf", "Inc", "Evc", "Ins", "Inf", "Qv", "Tpv", "Evs"]:
+        if dom is None:
+            dct["Maps"][v] = sim["Maps"][v].copy()
+        else:
+            dct["Maps"][v] = domain_scatter(values=sim["Maps"][v], ids=dom["Map"])
+    return dct
+
+
+def cellstats_setup(shape, stats="min-max-mean-var"):
+    """
+    Deploy per-cell streaming statistics accumulators (see cellstats_update())
+    :param shape: tuple of simulation domain shape
+    :param stats: string of statistics. Statistics must be concatenated by `-`. Options:
+    'min', 'max', 'mean', 'var' and 'std' (Welford algorithm), and 'pXX' for the XX%
+    quantile (P-square algorithm of Jain and Chlamtac, 1985). Example: min-max-var-p95
+    :return: dict of accumulators
+    """
+    stats = stats.split("-")
+    acc = {"Stats": stats, "Count": 0}
+    for st in stats:
+        if st == "min":
+            acc["min"] = np.full(shape, np.inf, dtype="float64")
+        elif st == "max":
+            acc["max"] = np.full(shape, -np.inf, dtype="float64")
+        elif st in ["mean", "var", "std"]:
+            acc["mean"] = np.zeros(shape, dtype="float64")
+            acc["M2"] = np.zeros(shape, dtype="float64")
+            acc["delta"] = np.zeros(shape, dtype="float64")
+        elif st.startswith("p"):
+            p = float(st[1:]) / 100
+            # markers heights, positions and desired positions
+            acc[st] = {
+                "p": p,
+                "q": np.zeros((5,) + tuple(shape), dtype="float64"),
+                "n": np.multiply.outer(np.arange(5.0), np.ones(shape)),
+                "np": np.array([0, 2 * p, 4 * p, 2 + 2 * p, 4])[:, np.newaxis],
+                "dn": np.array([0, p / 2, p, (1 + p) / 2, 1])[:, np.newaxis],
+            }
+        else:
+            raise ValueError("Statistic '{}' not found".format(st))
+    return acc
+
+
+def cellstats_update(acc, values):
+    """
+    Update per-cell streaming statistics with the values of a time step
+    :param acc: dict of accumulators (see cellstats_setup())
+    :param values: numpy array of domain values
+    :return: none
+    """
+    acc["Count"] = acc["Count"] + 1
+    count = acc["Count"]
+    if "min" in acc:
+        np.minimum(acc["min"], values, out=acc["min"])
+    if "max" in acc:
+        np.maximum(acc["max"], values, out=acc["max"])
+    if "mean" in acc:
+        # Welford running mean and sum of squared deviations
+        np.subtract(values, acc["mean"], out=acc["delta"])
+        acc["mean"] += acc["delta"] / count
+        acc["M2"] += acc["delta"] * (values - acc["mean"])
+    for st in acc["Stats"]:
+        if st.startswith("p"):
+            cellstats_p2(p2=acc[st], x=np.ravel(values), count=count)
+
+
+def cellstats_p2(p2, x, count):
+    """
+    P-square quantile estimator (Jain and Chlamtac, 1985) over all cells at once
+    :param p2: dict of P-square markers (see cellstats_setup())
+    :param x: 1d numpy array of cells values
+    :param count: int number of observations so far (including x)
+    :return: none
+    """
+    q = p2["q"].reshape(5, -1)
+    n = p2["n"].reshape(5, -1)
+    if count <= 5:
+        # the first observations are the markers
+        q[count - 1] = x
+        if count == 5:
+            q.sort(axis=0)
+        return
+    # find the cell of x and update the extreme markers
+    np.minimum(q[0], x, out=q[0])
+    np.maximum(q[4], x, out=q[4])
+    k = (x >= q[1]) * 1 + (x >= q[2]) + (x >= q[3])
+    n[1:] += np.arange(1, 5)[:, np.newaxis] > k
+    p2["np"] = p2["np"] + p2["dn"]
+    desired = p2["np"][:, 0]
+    # adjust the middle markers
+    for i in range(1, 4):
+        d = desired[i] - n[i]
+        move = ((d >= 1) * (n[i + 1] - n[i] > 1)) + ((d <= -1) * (n[i - 1] - n[i] < -1))
+        if not np.any(move):
+            continue
+        d = np.sign(d) * move
+        # parabolic prediction
+        qp = q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+        # linear prediction where the parabola is not monotonic
+        ql = np.where(
+            d > 0,
+            q[i] + (q[i + 1] - q[i]) / (n[i + 1] - n[i]),
+            q[i] - (q[i - 1] - q[i]) / (n[i - 1] - n[i]),
+        )
+        qp = np.where((q[i - 1] < qp) * (qp < q[i + 1]), qp, ql)
+        q[i] = np.where(move, qp, q[i])
+        n[i] = n[i] + d
+
+
+def cellstats_maps(acc):
+    """
+    Get the maps of per-cell streaming statistics
+    :param acc: dict of accumulators (see cellstats_setup())
+    :return: dict of numpy arrays of statistics
+    """
+    dct = dict()
+    count = acc["Count"]
+    for st in acc["Stats"]:
+        if st in ["min", "max", "mean"]:
+            dct[st] = acc[st].copy()
+        elif st == "var":
+            dct[st] = acc["M2"] / count
+        elif st == "std":
+            dct[st] = np.sqrt(acc["M2"] / count)
+        elif count >= 5:
+            dct[st] = acc[st]["q"][2].copy()
+        else:
+            # exact quantile of the few observations
+            dct[st] = np.quantile(acc[st]["q"][:count], acc[st]["p"], axis=0)
+    return dct
+
+
+def period_labels(dates, period="month", wy_month=10):
+    """
+    Calendar period labels of dates
+    :param dates: pandas series of dates
+    :param period: string of calendar period. Options:
+    'month' - e.g. 2013-01;
+    'season' - e.g. 2013-DJF (December is in the season of the next year);
+    'wateryear' - e.g. WY2014 (named by the year it ends)
+    :param wy_month: int month of the start of the water year
+    :return: 1d numpy array of string labels
+    """
+    import pandas as pd
+
+    dates = pd.Series(pd.to_datetime(dates))
+    if period == "month":
+        return dates.dt.strftime("%Y-%m").values
+    elif period == "season":
+        seasons = np.array(["DJF", "MAM", "JJA", "SON"])
+        years = dates.dt.year.values + (dates.dt.month.values == 12)
+        ids = (dates.dt.month.values % 12) // 3
+        return np.char.add(np.char.add(years.astype(str), "-"), seasons[ids])
+    elif period == "wateryear":
+        years = dates.dt.year.values + (dates.dt.month.values >= wy_month) * (
+            wy_month > 1
+        )
+        return np.char.add("WY", years.astype(str))
+    else:
+        raise ValueError(
+            "Period '{}' not found. Options: ['month', 'season', 'wateryear']".format(
+                period
+            )
+        )
+
+
+def aggregate_setup(periods, shape, aggvars, folder=None):
+    """
+    Deploy the online aggregation of maps in periods (see aggregate_update()).
+    Only the maps of open periods are kept, and periods are closed in their last time step.
+    :param periods: 1d numpy array of period labels of the time steps (see period_labels())
+    :param shape: tuple of simulation domain shape
+    :param aggvars: list of aggregated map variables
+    :param folder: None or string path to an existing folder to flush maps of closed
+    periods in aggregate_<var>_<period>.npy files
+    :return: dict of aggregation accumulators
+    """
+    close = dict()
+    for t in range(len(periods)):
+        close[periods[t]] = t
+    return {
+        "Periods": periods,
+        "Close": close,
+        "Vars": aggvars,
+        "Shape": shape,
+        "Folder": folder,
+        "Open": dict(),
+        "Peak": 0,
+        "Maps": {v: dict() for v in aggvars},
+        "Table": list(),
+    }
+
+
+def aggregate_update(acc, maps, t, dates, ids=None):
+    """
+    Add the maps of a time step to its open period, and close the period in its last
+    time step. Stocks are averaged and fluxes are summed (see esma_meanvars())
+    :param acc: dict of aggregation accumulators (see aggregate_setup())
+    :param maps: dict of simulation maps of the time step
+    :param t: int time step
+    :param dates: 1d numpy array of string dates of the time steps
+    :param ids: None or 2d numpy array of domain unit ids to scatter closed maps
+    (see domain_scatter())
+    :return: none
+    """
+    period = acc["Periods"][t]
+    if period not in acc["Open"]:
+        acc["Open"][period] = {"Start": t, "Days": 0, "Maps": dict()}
+        for v in acc["Vars"]:
+            acc["Open"][period]["Maps"][v] = np.zeros(
+                shape=acc["Shape"], dtype="float64"
+            )
+        acc["Peak"] = max(acc["Peak"], len(acc["Open"]))
+    lcl_aggr = acc["Open"][period]
+    for v in acc["Vars"]:
+        np.add(lcl_aggr["Maps"][v], maps[v], out=lcl_aggr["Maps"][v])
+    lcl_aggr["Days"] = lcl_aggr["Days"] + 1
+    if acc["Close"][period] == t:
+        # close period
+        lcl_aggr = acc["Open"].pop(period)
+        for v in acc["Vars"]:
+            lcl_map = lcl_aggr["Maps"][v]
+            if v in esma_meanvars():
+                lcl_map = lcl_map / lcl_aggr["Days"]
+            if ids is not None:
+                lcl_map = domain_scatter(values=lcl_map, ids=ids)
+            if acc["Folder"] is None:
+                acc["Maps"][v][period] = lcl_map
+            else:
+                lcl_file = "{}/aggregate_{}_{}.npy".format(acc["Folder"], v, period)
+                np.save(lcl_file, lcl_map)
+                acc["Maps"][v][period] = lcl_file
+        acc["Table"].append(
+            {
+                "Period": period,
+                "Start": dates[lcl_aggr["Start"]],
+                "End": dates[t],
+                "Days": lcl_aggr["Days"],
+            }
+        )
+
+
+def aggregate_maps(acc, frame=True):
+    """
+    Aggregated maps of the closed periods
+    :param acc: dict of aggregation accumulators (see aggregate_setup())
+    :param frame: boolean to return the periods table as a pandas dataframe
+    :return: dict of 'Periods' (table of closed periods) and 'Maps'
+    (dict of variables and dict of period maps or .npy files)
+    """
+    periods = acc["Table"]
+    if frame:
+        import pandas as pd
+
+        periods = pd.DataFrame(periods)
+    return {"Periods": periods, "Maps": acc["Maps"]}
+
+
+def simulation(
+    series_df,
+    basin,
+    htwi,
+    qt0,
+    cpmax,
+    sfmax,
+    roots,
+    qo,
+    m,
+    lamb,
+    ksat,
+    rho,
+    c,
+    n,
+    k,
+    scale=1000,
+    lat=-30,
+    trace=False,
+    tracevars="D-Cp",
+    integrate=False,
+    integratevars="D-Qv",
+    mode="grid",
+    hru_bins=100,
+    backend="numpy",
+    trace_folder=None,
+    checkpoints=None,
+    state0=None,
+    pet_field=None,
+    precision="packed",
+    labels=None,
+    labelvars="Q-R-ET-VSA",
+    aggregate=None,
+    aggregatevars="D-ET",
+    aggregate_folder=None,
+    wy_month=10,
+    stats=None,
+    statsvars="Qv-VSA",
+    frame=True,
+    outputs=None,
+):
+    """
+
+    g2g simulation model
+
+    Simulated variables:
+
+    'D',    # saturated water stock deficit
+    'Vz',   # vadose (unsaturated) zone water stock
+    'Sf',   # surface water stock
+    'Cp',   # canopy water stock
+    'VSA',  # variable source area
+    'P',    # precipitation
+    'PET',  # potential evapotranspiration
+    'Inc',  # interceptation in canopy
+    'Ins',  # interceptation in surface
+    'TF',   # throughfall
+    'R',    # runoff
+    'RIE',  # infiltration excess runoff (Hortonian)
+    'RSE',  # saturation excess runoff (Dunnean)
+    'RC',   # runofff coeficient (%)
+    'Inf',  # infiltration
+    'Qv',   # recharge
+    'Evc',  # evaporation from the canopy
+    'Evs',  # evaporation from the surface
+    'Tpu', # transpiration from the unsaturated zone
+    'Tps', # transpiration from the saturated zone
+    'ET',   # evapotranspiration
+    'Qb',   # baseflow
+    'Qs',   # stormflow
+    'Q'     # streamflow
+
+    :param series_df: pandas dataframe of timeseries
+    :param basin: 2d numpy array of basin area
+    :param htwi: numpy array of HTWI map (positive values only)
+    :param qt0: float of initial condition of baseflow in mm/d
+    :param cpmax: float or 2d numpy array of canopy water stock capacity in mm
+    :param sfmax: float or 2d numpy array of surface water stock capacity in mm
+    :param roots: float or 2d numpy array of effective root zone depth in mm
+    :param qo: float of full saturation baseflow in mm/d
+    :param m: float of the scaling parameter in mm
+    :param lamb: float the TWI threshold
+    :param ksat: float or 2d numpy array of daily hydraulic conductivity in mm/d
+    :param n: float of number of linear reservoirs (n >= 1)
+    :param k: float of detention time of linear reservoirs (k >= 1)
+    :param scale: int value to scale maps to integer format (recommended scale >= 1000)
+    :param trace: boolean to trace back daily maps of variables
+    :param tracevars: string of variables to trace back. Variables must be concatenated by `-`.
+    Example: D-Cp-VSA
+    :param integrate: boolean to integrate back maps of variables
+    :param integratevars: string of variables to integrate back. Variables must be concatenated by `-`.
+    Example: D-Cp-VSA
+    :param mode: string of simulation domain. Options:
+    'grid' - simulate every cell of the map grid;
+    'active' - simulate only the active cells of the basin (see active_domain());
+    'hru' - simulate unique hydrologic response units of the basin (see hru_domain())
+    :param hru_bins: int number of HTWI bins in 'hru' mode
+    :param backend: string of ESMA step kernel. Options:
+    'numpy' - reference NumPy kernel (see esma_step_numpy());
+    'inplace' - preallocated in-place kernel (see esma_step_inplace());
+    'events' - in-place kernel skipping dry cells in dry steps (see esma_step_events());
+    'jit' - JIT compiled per-cell kernel, requires numba (see esma_step_jit())
+    :param trace_folder: None or string path to an existing folder to store traced maps
+    on disk. Each variable is a memory-mapped trace_<var>.npy file written one time step at a time.
+    :param checkpoints: None or list of dates (string YYYY-MM-DD) to save the simulation state.
+    Use 'last' for the last date of the series.
+    :param state0: None or python dict of a saved state (see esma_state()) to warm start
+    the simulation instead of qt0. The series must start in the day after the state date.
+    :param pet_field: None or python dict of distributed PET setup (see pet_field()) to
+    evaluate PET maps from cells latitude and lapsed temperature instead of the lat PET.
+    The series PET is the basin average of the PET maps (not rounded).
+    :param precision: string of maps precision. Options:
+    'packed' - float64 maps scaled by scale and uint16 traces (traces wrap above 65535 scaled units);
+    'float32' - float32 maps and traces in mm with no scaling (needs the 'inplace' or 'jit' backend)
+    :param labels: None or 2d numpy array of integer labels of sub-basins (labels <= 0 are skipped)
+    to aggregate series of each label in the same run (see label_domain())
+    :param labelvars: string of variables aggregated by label. Variables must be concatenated by `-`.
+    Q and Qs route the label R series, while Qb is the global baseflow. Warm starts
+    route the label R series from the global pending runoff of state0.
+    Example: Q-R-ET-VSA
+    :param aggregate: None or string of calendar period of aggregated maps. Options:
+    'month', 'season', 'wateryear' (see period_labels()) or the name of a series_df
+    field of custom date bins. Stocks are averaged and fluxes are summed in each period.
+    Only the maps of open periods are kept, and periods are closed in their last date.
+    :param aggregatevars: string of variables to aggregate. Variables must be concatenated by `-`.
+    Example: D-ET-VSA
+    :param aggregate_folder: None or string path to an existing folder to flush maps of closed
+    periods in aggregate_<var>_<period>.npy files
+    :param wy_month: int month of the start of the water year
+    :param stats: None or string of per-cell statistics of maps updated at each time step
+    (see cellstats_setup()). Statistics must be concatenated by `-`. Example: min-max-var-p95
+    :param statsvars: string of variables of statistics. Variables must be concatenated by `-`.
+    Example: Qv-VSA (the VSA mean is the saturation frequency map)
+    :param frame: boolean to return the series, labels and periods as pandas dataframes.
+    Otherwise they are returned as dicts of numpy arrays (the series fields are
+    views of one block) and the periods as a list of dicts.
+    :param outputs: None (all variables) or string of requested series variables.
+    Variables must be concatenated by `-`. Example: Q-ET.
+    Only the fluxes and reductions needed by the outputs and by the traced, integrated,
+    aggregated, labelled and statistics maps are evaluated (see esma_needs()).
+    The series holds the input fields and the evaluated global variables.
+    :return: python dict containing:
+
+    {'Series': simulated time series pandas dataframe (or dict of 1d numpy arrays),
+     'Trace': dict of 3d numpy arrays (or memory-mapped arrays) of traced variables,
+     'Integration': dict of 2d numpy arrays of integrated variables,
+     'States': dict of saved states of checkpoints dates,
+     'Labels': None or pandas dataframe of label series (multi-index of Label and Date),
+     or dict of 'Label', 'Date' and 2d numpy arrays (labels, time) of variables,
+     'Aggregation': None or dict of 'Periods' (pandas dataframe or list of periods) and 'Maps'
+     (dict of variables of dict of periods maps, or file paths if flushed to disk),
+     'Stats': None or dict of variables of dict of 2d numpy arrays of statistics (in map units),
+     'Memory': dict of MB of simulation maps, work buffers, parameters, traces and integrations}
 
-        # ---- Recharge
+    """
+    from sys import getsizeof
 
-        # Vadose zone saturation
-        unz_sat = mps["Vz"] / (mps["D"] + (scale / 1000))
-        unz_sat = np.nan_to_num(unz_sat, nan=0)
-        unz_sat = (unz_sat * (unz_sat <= 1)) + (1 * (unz_sat > 1))
-        #
-        # potential recharge
-        p_qv = (ksat * scale) * unz_sat
-        #
-        # Recharge
-        mps["Qv"] = (p_qv * (mps["Vz"] > p_qv)) + (mps["Vz"] * (mps["Vz"] <= p_qv))
-        df_ts["Qv"].values[t] = (
-            avg_2d(var2d=mps["Qv"], weight=basin) / scale
-        )  # compute basin-wide avg
+    # variables to evaluate
+    needs = None
+    if outputs is not None:
+        lcl_series = outputs.split("-")
+        lcl_maps = list()
+        if trace:
+            lcl_maps = lcl_maps + tracevars.split("-")
+        if integrate:
+            lcl_maps = lcl_maps + integratevars.split("-")
+        if stats is not None:
+            lcl_maps = lcl_maps + statsvars.split("-")
+        if aggregate is not None:
+            lcl_maps = lcl_maps + aggregatevars.split("-")
+        if labels is not None:
+            for v in labelvars.split("-"):
+                if v in ["Q", "Qs"]:
+                    lcl_maps.append("R")
+                    lcl_series.append("Qb")
+                elif v == "Qb":
+                    lcl_series.append("Qb")
+                else:
+                    lcl_maps.append(v)
+        if len(checkpoints or []) > 0:
+            # states hold the pending routed runoff
+            lcl_series.append("R")
+        needs = esma_needs(seriesvars=lcl_series, mapvars=lcl_maps)
+
+    # deploy simulation
+    sim = esma_setup(
+        series_df=series_df,
+        basin=basin,
+        htwi=htwi,
+        qt0=qt0,
+        cpmax=cpmax,
+        sfmax=sfmax,
+        roots=roots,
+        qo=qo,
+        m=m,
+        lamb=lamb,
+        ksat=ksat,
+        rho=rho,
+        c=c,
+        scale=scale,
+        lat=lat,
+        mode=mode,
+        hru_bins=hru_bins,
+        backend=backend,
+        state0=state0,
+        pet_field=pet_field,
+        precision=precision,
+        needs=needs,
+    )
+    ser = sim["Series"]
+    mps = sim["Maps"]
+    dom = sim["Domain"]
+    tlen = len(ser["Date"])
+    shape = np.shape(sim["Weight"])
 
-        # ---- Transpiration from vadose zone
-        #
-        # transpiration factor for accounting root depth in the vadoze zone
-        tp_factor = (rzd * scale) / (mps["D"] + (scale / 1000))
-        tp_factor = np.nan_to_num(
-            tp_factor, nan=1, posinf=1
-        )  # avoid nan values where D is 0
-        tp_factor = (tp_factor * (tp_factor < 1)) + (1 * (tp_factor >= 1))
-        #
-        # potential tp
-        p_tpun_1 = mps["Vz"] - mps["Qv"]
-        p_tpun = (p_tpun_1 * ((rzd * scale) > mps["D"])) + (
-            p_tpun_1 * tp_factor * ((rzd * scale) <= mps["D"])
-        )
-        #
-        # Transpiration from vadose zone
-        mps["Tpv"] = (mps["PET"] * (p_tpun > mps["PET"])) + (
-            p_tpun * (p_tpun <= mps["PET"])
+    # deploy trace and integration maps
+    mps_trace = dict()
+    # store as uint16 (unsigned 16-bit integer) in packed precision
+    trace_dtype = "uint16"
+    if precision == "float32":
+        trace_dtype = "float32"
+    if trace:
+        tracevars = tracevars.split("-")
+        mem_size = 0
+        for v in tracevars:
+            if trace_folder is None:
+                mps_trace[v] = np.zeros(shape=(tlen,) + shape, dtype=trace_dtype)
+                mem_size = getsizeof(mps_trace[v]) + mem_size
+            else:
+                # disk-backed maps in grid shape
+                mps_trace[v] = np.lib.format.open_memmap(
+                    "{}/trace_{}.npy".format(trace_folder, v),
+                    mode="w+",
+                    dtype=trace_dtype,
+                    shape=(tlen,) + np.shape(basin),
+                )
+                mem_size = mps_trace[v].nbytes + mem_size
+        print("Trace size : {} MB".format(mem_size / 1000000))
+        if trace_folder is not None and dom is not None:
+            mask = dom["Map"] >= 0
+            ids = dom["Map"][mask]
+    mps_integrate = dict()
+    if integrate:
+        integratevars = integratevars.split("-")
+        for v in integratevars:
+            mps_integrate[v] = np.zeros(shape=shape, dtype="float64")
+
+    # streaming statistics
+    if stats is not None:
+        statsvars = statsvars.split("-")
+        mps_stats = {v: cellstats_setup(shape=shape, stats=stats) for v in statsvars}
+
+    # label aggregation
+    if labels is not None:
+        lbl = label_domain(
+            labels=labels, basin=basin, ids=None if dom is None else dom["Map"]
         )
-        df_ts["Tpv"].values[t] = (
-            avg_2d(var2d=mps["Tpv"], weight=basin) / scale
-        )  # compute basin-wide avg
-        #
-        # update PET
-        mps["PET"] = mps["PET"] - np.mean(mps["Tpv"])
-
-        # Evaporation from the surface
-        # potential Evs
-        p_evs = mps["Sf"] - mps["Inf"]
-        # Evs
-        mps["Evs"] = (mps["PET"] * (p_evs > mps["PET"])) + (
-            p_evs * (p_evs <= mps["PET"])
+        labelvars = labelvars.split("-")
+        lbl_mapvars = [v for v in labelvars if v not in ["Q", "Qs", "Qb"]]
+        if ("Q" in labelvars or "Qs" in labelvars) and "R" not in lbl_mapvars:
+            lbl_mapvars.append("R")
+        mps_labels = np.zeros(shape=(len(lbl_mapvars), len(lbl["Labels"]), tlen))
+        lbl_tmp = np.zeros(len(lbl["Units"]), dtype=mps["D"].dtype)
+
+    # online temporal aggregation
+    if aggregate is not None:
+        aggregatevars = aggregatevars.split("-")
+        if aggregate in series_df.columns:
+            aggr_labels = series_df[aggregate].astype(str).values
+        else:
+            aggr_labels = period_labels(
+                dates=ser["Date"], period=aggregate, wy_month=wy_month
+            )
+        aggr = aggregate_setup(
+            periods=aggr_labels,
+            shape=shape,
+            aggvars=aggregatevars,
+            folder=aggregate_folder,
         )
-        df_ts["Evs"].values[t] = (
-            avg_2d(var2d=mps["Evs"], weight=basin) / scale
-        )  # compute basin-wide avg
 
-        # --- Baseflow
-        df_ts["Qb"].values[t] = topmodel_qb(d=df_ts["D"].values[t], qo=qo, m=m)
+    # dates of saved states
+    states = dict()
+    if checkpoints is None:
+        checkpoints = []
+    ts_dates = np.datetime_as_string(ser["Date"], unit="D")
+    checkpoints = [ts_dates[-1] if d == "last" else str(d)[:10] for d in checkpoints]
 
-        # --- ET
-        mps["Tp"] = mps["Tps"] + mps["Tpv"]  # Tp
-        mps["Ev"] = mps["Evc"] + mps["Evs"]  # Ev
-        mps["ET"] = mps["Evc"] + mps["Evs"] + mps["Tps"] + mps["Tpv"]
-        df_ts["ET"].values[t] = (
-            avg_2d(var2d=mps["ET"], weight=basin) / scale
-        )  # compute basin-wide avg
+    # ESMA loop
+    for t in range(tlen):
+        esma_advance(sim=sim, t=t)
+        #
+        # aggregate labels
+        if labels is not None:
+            for i in range(len(lbl_mapvars)):
+                if t + sim["Offset"] == 0 and lbl_mapvars[i] in esma_stockvars():
+                    pass  # stocks are not balanced in the first step
+                else:
+                    mps_labels[i, :, t] = label_average(
+                        values=mps[lbl_mapvars[i]], lbl=lbl, tmp=lbl_tmp
+                    )
+        #
+        # save state
+        if ts_dates[t] in checkpoints:
+            states[ts_dates[t]] = esma_state(sim=sim, t=t)
+            states[ts_dates[t]]["t"] = t
         #
         # append to trace and integration
         if trace:
             for v in tracevars:
-                mps_trace[v][t] = mps[v]
+                if trace_folder is not None and dom is not None:
+                    mps_trace[v][t][mask] = mps[v][ids]
+                else:
+                    mps_trace[v][t] = mps[v]
         if integrate:
             for v in integratevars:
-                mps_integrate[v] = mps_integrate[v] + mps[v]
+                np.add(mps_integrate[v], mps[v], out=mps_integrate[v])
+        if stats is not None:
+            for v in statsvars:
+                cellstats_update(acc=mps_stats[v], values=mps[v])
+        if aggregate is not None:
+            aggregate_update(
+                acc=aggr,
+                maps=mps,
+                t=t,
+                dates=ts_dates,
+                ids=None if dom is None else dom["Map"],
+            )
+    #
+    # memory accounting of the loop
+    mem = esma_memory(sim=sim)
+    mem["Trace"] = sum([mps_trace[v].nbytes for v in mps_trace])
+    mem["Integration"] = sum([mps_integrate[v].nbytes for v in mps_integrate])
+    if labels is not None:
+        mem["Labels"] = mps_labels.nbytes
+    if aggregate is not None:
+        # maps of open periods
+        mem["Aggregation"] = aggr["Peak"] * len(aggregatevars) * np.prod(shape) * 8
+    if stats is not None:
+        mem["Stats"] = 0
+        for v in statsvars:
+            for acc in mps_stats[v].values():
+                if isinstance(acc, dict):
+                    # P-square markers heights and positions
+                    mem["Stats"] = mem["Stats"] + acc["q"].nbytes + acc["n"].nbytes
+                elif isinstance(acc, np.ndarray):
+                    mem["Stats"] = mem["Stats"] + acc.nbytes
+    mem = {v: mem[v] / 1000000 for v in mem}
     #
     #
     # RUNOFF ROUTING by Nash Cascade of linear reservoirs
     if n < 1:
         n = 1.0
-    df_ts["Qs"] = nash_cascade(df_ts["R"].values, k=k, n=n)
+    if "Qs" in ser:
+        ser["Qs"][...] = nash_cascade(ser["R"], k=k, n=n)
+        if state0 is not None:
+            # add routed runoff still pending from the warm start state
+            lcl_qs = state0["Qs"][:tlen]
+            ser["Qs"][: len(lcl_qs)] += lcl_qs
+    for d in states:
+        # routed runoff pending after the state date
+        t = states[d].pop("t")
+        lcl_size = max(tlen, nash_horizon(k=k, n=n))
+        lcl_qs = nash_pending(q=ser["R"][: t + 1], k=k, n=n, size=lcl_size)
+        if state0 is not None:
+            lcl_pending = state0["Qs"][t + 1 : t + 1 + lcl_size]
+            lcl_qs[: len(lcl_pending)] += lcl_pending
+        states[d]["Qs"] = lcl_qs
     #
     #
     # Compute full discharge Q = Qb + Qs
-    df_ts["Q"] = df_ts["Qb"] + df_ts["Qs"]
+    if "Q" in ser:
+        np.add(ser["Qb"], ser["Qs"], out=ser["Q"])
 
     # compute global Tp and Ev
-    df_ts["Tp"] = df_ts["Tpv"] + df_ts["Tps"]
-    df_ts["Ev"] = df_ts["Evc"] + df_ts["Evs"]
+    if "Tp" in ser:
+        np.add(ser["Tpv"], ser["Tps"], out=ser["Tp"])
+    if "Ev" in ser:
+        np.add(ser["Evc"], ser["Evs"], out=ser["Ev"])
+
+    # series table
+    if frame:
+        df_ts = esma_frame(ser=ser)
+    else:
+        df_ts = {v: ser[v] for v in ser["Fields"]}
+
+    # label series table
+    df_labels = None
+    if labels is not None:
+        dct = dict()
+        for i in range(len(lbl_mapvars)):
+            v = lbl_mapvars[i]
+            if v in esma_avgvars():
+                factors = esma_avgvars(scale=sim["scale"])[v]
+            else:
+                factors = (1, sim["scale"])
+            dct[v] = factors[0] * mps_labels[i] / factors[1]
+        if "Qb" in labelvars or "Q" in labelvars:
+            dct["Qb"] = np.ones(shape=(len(lbl["Labels"]), 1)) * ser["Qb"]
+        if "Qs" in labelvars or "Q" in labelvars:
+            dct["Qs"] = nash_cascade(dct["R"], k=k, n=n)
+            if state0 is not None:
+                # the state keeps only the global pending runoff: start every label from it
+                lcl_qs = state0["Qs"][:tlen]
+                dct["Qs"][:, : len(lcl_qs)] += lcl_qs
+        if "Q" in labelvars:
+            dct["Q"] = dct["Qb"] + dct["Qs"]
+        if frame:
+            import pandas as pd
+
+            index = pd.MultiIndex.from_product(
+                [lbl["Labels"], ser["Date"]], names=["Label", "Date"]
+            )
+            df_labels = pd.DataFrame(
+                {v: np.ravel(dct[v]) for v in labelvars}, index=index
+            )
+        else:
+            df_labels = {v: dct[v] for v in labelvars}
+            df_labels["Label"] = lbl["Labels"]
+            df_labels["Date"] = ser["Date"]
+
+    # aggregation periods table
+    aggregation = None
+    if aggregate is not None:
+        aggregation = aggregate_maps(acc=aggr, frame=frame)
+
+    # statistics maps
+    maps_stats = None
+    if stats is not None:
+        maps_stats = dict()
+        for v in statsvars:
+            maps_stats[v] = cellstats_maps(acc=mps_stats[v])
+            if mode != "grid":
+                for st in maps_stats[v]:
+                    maps_stats[v][st] = domain_scatter(
+                        values=maps_stats[v][st], ids=dom["Map"]
+                    )
 
     # average stocks in integration:
     if integrate:
         for v in integratevars:
-            if v in ["D", "Cp", "Sf", "Vz", "VSA", "RC"]:
+            if v in esma_meanvars():
                 mps_integrate[v] = mps_integrate[v] / tlen
+    #
+    # scatter domain units back to maps
+    if trace_folder is not None:
+        for v in mps_trace:
+            mps_trace[v].flush()
+    if mode != "grid":
+        if trace_folder is None:
+            for v in mps_trace:
+                mps_trace[v] = domain_scatter(values=mps_trace[v], ids=dom["Map"])
+        for v in mps_integrate:
+            mps_integrate[v] = domain_scatter(values=mps_integrate[v], ids=dom["Map"])
     # return
-    return {"Series": df_ts, "Trace": mps_trace, "Integration": mps_integrate}
+    return {
+        "Series": df_ts,
+        "Trace": mps_trace,
+        "Integration": mps_integrate,
+        "States": states,
+        "Labels": df_labels,
+        "Aggregation": aggregation,
+        "Stats": maps_stats,
+        "Memory": mem,
+    }
+
+
+def simulation_append(
+    run,
+    series_df,
+    basin,
+    htwi,
+    cpmax,
+    sfmax,
+    roots,
+    qo,
+    m,
+    lamb,
+    ksat,
+    rho,
+    c,
+    n,
+    k,
+    scale=1000,
+    lat=-30,
+    mode="grid",
+    hru_bins=100,
+    backend="numpy",
+    pet_field=None,
+    precision="packed",
+):
+    """
+
+    Append new days to a saved simulation run. Only the new days are simulated,
+    starting from the state of the last day of the run. Routing continues from the
+    runoff still pending in the state, so the history is not routed again.
+
+    The run must hold the state of its last date (run simulation() with checkpoints=['last']).
+    The appended run holds the state of its new last date, so appends can be chained.
+    Traced maps are not appended.
+
+    :param run: python dict of a simulation run (see simulation())
+    :param series_df: pandas dataframe of the new days timeseries
+    :param basin: 2d numpy array of basin area
+    :param htwi: numpy array of HTWI map (positive values only)
+    :param cpmax: float or 2d numpy array of canopy water stock capacity in mm
+    :param sfmax: float or 2d numpy array of surface water stock capacity in mm
+    :param roots: float or 2d numpy array of effective root zone depth in mm
+    :param qo: float of full saturation baseflow in mm/d
+    :param m: float of the scaling parameter in mm
+    :param lamb: float the TWI threshold
+    :param ksat: float or 2d numpy array of daily hydraulic conductivity in mm/d
+    :param rho: float of root zone depth factor
+    :param c: float of Oudin PET model scalar parameter
+    :param n: float of number of linear reservoirs (n >= 1)
+    :param k: float of detention time of linear reservoirs (k >= 1)
+    :param scale: int value to scale maps
+    :param lat: float of latitude in degrees
+    :param mode: string of simulation domain (see simulation())
+    :param hru_bins: int number of HTWI bins in 'hru' mode
+    :param backend: string of ESMA step kernel (see simulation())
+    :param pet_field: None or python dict of distributed PET setup (see simulation())
+    :param precision: string of maps precision (see simulation())
+    :return: python dict of the appended run (see simulation())
+    """
+    import pandas as pd
+
+    # get state of the last date
+    last = pd.to_datetime(run["Series"]["Date"].values[-1]).strftime("%Y-%m-%d")
+    if last not in run["States"]:
+        raise ValueError("Run has no state of its last date: {}".format(last))
+    # simulate new days
+    integratevars = list(run["Integration"])
+    new = simulation(
+        series_df=series_df,
+        basin=basin,
+        htwi=htwi,
+        qt0=None,
+        cpmax=cpmax,
+        sfmax=sfmax,
+        roots=roots,
+        qo=qo,
+        m=m,
+        lamb=lamb,
+        ksat=ksat,
+        rho=rho,
+        c=c,
+        n=n,
+        k=k,
+        scale=scale,
+        lat=lat,
+        integrate=len(integratevars) > 0,
+        integratevars="-".join(integratevars),
+        mode=mode,
+        hru_bins=hru_bins,
+        backend=backend,
+        checkpoints=["last"],
+        state0=run["States"][last],
+        pet_field=pet_field,
+        precision=precision,
+    )
+    # append series
+    tlen_old = len(run["Series"])
+    tlen_new = len(new["Series"])
+    df_ts = pd.concat([run["Series"], new["Series"]], ignore_index=True)
+    # append integrations
+    mps_integrate = dict()
+    for v in integratevars:
+        if v in esma_meanvars():
+            mps_integrate[v] = (
+                run["Integration"][v] * tlen_old + new["Integration"][v] * tlen_new
+            ) / (tlen_old + tlen_new)
+        else:
+            mps_integrate[v] = run["Integration"][v] + new["Integration"][v]
+    return {
+        "Series": df_ts,
+        "Trace": dict(),
+        "Integration": mps_integrate,
+        "States": new["States"],
+        "Labels": None,
+        "Aggregation": None,
+        "Stats": None,
+        "Memory": new["Memory"],
+    }
+
+
+def inputs_hash(*args):
+    """
+    Content hash of simulation inputs and parameters
+    :param args: pandas dataframes, numpy arrays, scalars, strings, None, lists or dicts
+    :return: string of hexadecimal digest
+    """
+    import hashlib
+    import pandas as pd
+
+    def update(h, obj):
+        if isinstance(obj, pd.DataFrame):
+            h.update(str(list(obj.columns)).encode())
+            h.update(pd.util.hash_pandas_object(obj, index=False).values.tobytes())
+        elif isinstance(obj, np.ndarray):
+            h.update("{}{}".format(obj.dtype, obj.shape).encode())
+            h.update(np.ascontiguousarray(obj).tobytes())
+        elif isinstance(obj, dict):
+            for key in sorted(obj):
+                h.update(str(key).encode())
+                update(h, obj[key])
+        elif isinstance(obj, (list, tuple)):
+            for item in obj:
+                update(h, item)
+        else:
+            h.update(repr(obj).encode())
+
+    h = hashlib.sha1()
+    for obj in args:
+        update(h, obj)
+    return h.hexdigest()
+
+
+def code_version():
+    """
+    Content hash of the model code and of the numpy version, so cached
+    simulation runs expire when the code changes
+    :return: string of hexadecimal digest
+    """
+    import hashlib
+
+    h = hashlib.sha1(np.__version__.encode())
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def simulation_cache_evict(cache_folder, cache_size=1000):
+    """
+    Evict the least recently used runs of a simulation cache (see simulation_cached())
+    until the cache fits its size. The most recent run is always kept.
+    :param cache_folder: string path to the folder of the cache
+    :param cache_size: float of maximum size of the cache in MB
+    :return: list of evicted run folders
+    """
+    import os
+    import shutil
+
+    runs = list()
+    for name in os.listdir(cache_folder):
+        path = "{}/{}".format(cache_folder, name)
+        if name.startswith("sim_") and not name.endswith(".tmp"):
+            size = sum(
+                os.path.getsize("{}/{}".format(path, f)) for f in os.listdir(path)
+            )
+            runs.append((os.path.getmtime(path), path, size))
+    runs.sort()
+    total = sum(run[2] for run in runs)
+    evicted = list()
+    while total > cache_size * 1e6 and len(runs) > 1:
+        mtime, path, size = runs.pop(0)
+        shutil.rmtree(path)
+        total = total - size
+        evicted.append(path)
+    return evicted
+
+
+def simulation_cached(cache_folder, cache_size=1000, **kwargs):
+    """
+
+    Memoized simulation() with a content-addressed cache on disk.
+
+    Runs are keyed by the hash of the forcing series, maps, parameters and options
+    (see inputs_hash()) and of the model code (see code_version()), and stored in
+    sim_<hash> folders of the cache. On a hit the stored run is returned without
+    simulating: the traced maps are read-only memory-mapped arrays of the cache
+    trace_<var>.npy files. The modification time of a run folder is its last use,
+    and the least recently used runs are evicted when the cache outgrows its size.
+
+    Runs with trace_folder or aggregate_folder write files out of the cache,
+    so they are simulated and not cached.
+
+    :param cache_folder: string path to an existing folder of the cache
+    :param cache_size: float of maximum size of the cache in MB
+    :param kwargs: simulation() parameters
+    :return: python dict of the simulation run (see simulation())
+    """
+    import os
+    import pickle
+    import shutil
+
+    if kwargs.get("trace_folder") is not None:
+        return simulation(**kwargs)
+    if kwargs.get("aggregate_folder") is not None:
+        return simulation(**kwargs)
+    key = inputs_hash(code_version(), kwargs)
+    folder = "{}/sim_{}".format(cache_folder, key)
+    #
+    # look up the cache
+    if os.path.isdir(folder):
+        print("Simulation loaded from cache : {}".format(folder))
+        with open("{}/run.pkl".format(folder), "rb") as f:
+            run = pickle.load(f)
+        run["Trace"] = {
+            v: np.load("{}/trace_{}.npy".format(folder, v), mmap_mode="r")
+            for v in run["Trace"]
+        }
+        os.utime(folder)  # mark as the most recently used
+        return run
+    #
+    # simulate and save to cache
+    run = simulation(**kwargs)
+    tmp = "{}.{}.tmp".format(folder, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    for v in run["Trace"]:
+        np.save("{}/trace_{}.npy".format(tmp, v), run["Trace"][v])
+    dct = dict(run)
+    dct["Trace"] = list(run["Trace"])
+    with open("{}/run.pkl".format(tmp), "wb") as f:
+        pickle.dump(dct, f, protocol=pickle.HIGHEST_PROTOCOL)
+    # the run only shows up in the cache when complete
+    try:
+        os.replace(tmp, folder)
+    except OSError:  # saved meanwhile by another process
+        shutil.rmtree(tmp)
+    simulation_cache_evict(cache_folder=cache_folder, cache_size=cache_size)
+    return run
+
+
+def simulation_spinup(
+    series_df,
+    basin,
+    htwi,
+    qt0,
+    cpmax,
+    sfmax,
+    roots,
+    qo,
+    m,
+    lamb,
+    ksat,
+    rho,
+    c,
+    n,
+    k,
+    scale=1000,
+    lat=-30,
+    mode="grid",
+    hru_bins=100,
+    backend="numpy",
+    tol=0.01,
+    cycles=20,
+    cache_folder=None,
+    pet_field=None,
+    precision="packed",
+):
+    """
+
+    Spin-up of the initial state. The warm up series is simulated over and over,
+    each cycle starting from the state of the end of the previous cycle, until the
+    global D and the Cp, Vz and Sf maps change less than the tolerance.
+
+    The state is dated in the day before the warm up series, so it is the state0
+    of a simulation starting in the same day of the warm up series (see simulation()).
+
+    :param series_df: pandas dataframe of the warm up timeseries (e.g. the first year)
+    :param basin: 2d numpy array of basin area
+    :param htwi: numpy array of HTWI map (positive values only)
+    :param qt0: float of initial condition of baseflow in mm/d of the first cycle
+    :param cpmax: float or 2d numpy array of canopy water stock capacity in mm
+    :param sfmax: float or 2d numpy array of surface water stock capacity in mm
+    :param roots: float or 2d numpy array of effective root zone depth in mm
+    :param qo: float of full saturation baseflow in mm/d
+    :param m: float of the scaling parameter in mm
+    :param lamb: float the TWI threshold
+    :param ksat: float or 2d numpy array of daily hydraulic conductivity in mm/d
+    :param rho: float of root zone depth factor
+    :param c: float of Oudin PET model scalar parameter
+    :param n: float of number of linear reservoirs (n >= 1)
+    :param k: float of detention time of linear reservoirs (k >= 1)
+    :param scale: int value to scale maps
+    :param lat: float of latitude in degrees
+    :param mode: string of simulation domain (see simulation())
+    :param hru_bins: int number of HTWI bins in 'hru' mode
+    :param backend: string of ESMA step kernel (see simulation())
+    :param tol: float of convergence tolerance in mm
+    :param cycles: int maximum number of cycles
+    :param cache_folder: None or string path to an existing folder to cache spin-up states.
+    States are saved in spinup_<hash>.npz files, where the hash is taken of the inputs,
+    parameters and model code (see code_version()), so later calls with the same inputs
+    load the state from disk.
+    :param pet_field: None or python dict of distributed PET setup (see simulation())
+    :param precision: string of maps precision (see simulation())
+    :return: python dict of the spin-up state (see esma_state())
+    """
+    import os
+
+    # look up the cache
+    if cache_folder is not None:
+        key = inputs_hash(
+            code_version(),
+            series_df,
+            basin,
+            htwi,
+            [qt0, cpmax, sfmax, roots, qo, m, lamb, ksat, rho, c, n, k],
+            [scale, lat, mode, hru_bins, backend, tol, cycles, precision],
+            pet_field,
+        )
+        fstate = "{}/spinup_{}.npz".format(cache_folder, key)
+        if os.path.exists(fstate):
+            from inp import sim_state
+
+            print("Spin-up state loaded from cache : {}".format(fstate))
+            return sim_state(file=fstate)
+    #
+    # cycle the warm up series
+    day0 = np.datetime64(series_df["Date"].values[0], "D") - 1
+    last = str(np.datetime64(series_df["Date"].values[-1], "D"))
+    state = None
+    for i in range(cycles):
+        run = simulation(
+            series_df=series_df,
+            basin=basin,
+            htwi=htwi,
+            qt0=qt0,
+            cpmax=cpmax,
+            sfmax=sfmax,
+            roots=roots,
+            qo=qo,
+            m=m,
+            lamb=lamb,
+            ksat=ksat,
+            rho=rho,
+            c=c,
+            n=n,
+            k=k,
+            scale=scale,
+            lat=lat,
+            mode=mode,
+            hru_bins=hru_bins,
+            backend=backend,
+            checkpoints=["last"],
+            state0=state,
+            pet_field=pet_field,
+            precision=precision,
+        )
+        new = run["States"][last]
+        # the end of the cycle is the start of the next cycle
+        new["Date"] = day0
+        if state is not None:
+            delta = abs(new["D"] - state["D"])
+            for v in [v for v in esma_stockvars() if v in new["Maps"]]:
+                lcl_delta = np.max(np.abs(new["Maps"][v] - state["Maps"][v]))
+                lcl_delta = lcl_delta / new["scale"]
+                delta = max(delta, lcl_delta)
+            print("Spin-up cycle {} : max change = {} mm".format(i + 1, delta))
+            if delta < tol:
+                state = new
+                break
+        state = new
+    else:
+        print("Spin-up did not converge in {} cycles".format(cycles))
+    #
+    # save to cache
+    if cache_folder is not None:
+        from out import export_state
+
+        export_state(state=state, folder=cache_folder, filename="spinup_" + key)
+    return state
+
+
+def simulation_stream(
+    series_df,
+    basin,
+    htwi,
+    qt0,
+    cpmax,
+    sfmax,
+    roots,
+    qo,
+    m,
+    lamb,
+    ksat,
+    rho,
+    c,
+    scale=1000,
+    lat=-30,
+    streamvars="D-Cp",
+    mode="grid",
+    hru_bins=100,
+    backend="numpy",
+    state0=None,
+    pet_field=None,
+    precision="packed",
+):
+    """
+
+    g2g simulation model as a generator of daily states and fluxes.
+    Memory does not grow with the series length since no map is kept back.
+
+    Yielded maps are overwritten or replaced at every step: copy them to keep values.
+    Streamflow routing needs the whole runoff series, so Qs and Q are not streamed
+    (route the R series with nash_cascade() after the run).
+
+    :param series_df: pandas dataframe of timeseries
+    :param basin: 2d numpy array of basin area
+    :param htwi: numpy array of HTWI map (positive values only)
+    :param qt0: float of initial condition of baseflow in mm/d
+    :param cpmax: float or 2d numpy array of canopy water stock capacity in mm
+    :param sfmax: float or 2d numpy array of surface water stock capacity in mm
+    :param roots: float or 2d numpy array of effective root zone depth in mm
+    :param qo: float of full saturation baseflow in mm/d
+    :param m: float of the scaling parameter in mm
+    :param lamb: float the TWI threshold
+    :param ksat: float or 2d numpy array of daily hydraulic conductivity in mm/d
+    :param rho: float of root zone depth factor
+    :param c: float of Oudin PET model scalar parameter
+    :param scale: int value to scale maps
+    :param lat: float of latitude in degrees
+    :param streamvars: string of map variables to stream. Variables must be concatenated by `-`.
+    Example: D-Cp-VSA. Use an empty string to stream only global variables.
+    :param mode: string of simulation domain (see simulation())
+    :param hru_bins: int number of HTWI bins in 'hru' mode
+    :param backend: string of ESMA step kernel (see simulation())
+    :param state0: None or python dict of a saved state to warm start (see simulation())
+    :param pet_field: None or python dict of distributed PET setup (see simulation())
+    :param precision: string of maps precision (see simulation())
+    :return: generator of python dict containing:
+
+    {'t': int time step,
+     'Date': date of time step,
+     'Series': dict of float global variables of time step,
+     'Maps': dict of 2d numpy arrays of streamed variables (scaled)}
+
+    """
+    # deploy simulation
+    sim = esma_setup(
+        series_df=series_df,
+        basin=basin,
+        htwi=htwi,
+        qt0=qt0,
+        cpmax=cpmax,
+        sfmax=sfmax,
+        roots=roots,
+        qo=qo,
+        m=m,
+        lamb=lamb,
+        ksat=ksat,
+        rho=rho,
+        c=c,
+        scale=scale,
+        lat=lat,
+        mode=mode,
+        hru_bins=hru_bins,
+        backend=backend,
+        state0=state0,
+        pet_field=pet_field,
+        precision=precision,
+    )
+    ser = sim["Series"]
+    mps = sim["Maps"]
+    dom = sim["Domain"]
+    tlen = len(ser["Date"])
+    # global variables of the series
+    globalvars = [v for v in esma_simvars() if v in ser["Fields"]]
+    globalvars = [v for v in globalvars if v not in ["Qs", "Q"]]
+    # deploy streamed maps
+    streamvars = [v for v in streamvars.split("-") if v != ""]
+    mps_stream = dict()
+    if dom is not None:
+        mask = dom["Map"] >= 0
+        ids = dom["Map"][mask]
+        for v in streamvars:
+            mps_stream[v] = np.zeros(shape=np.shape(dom["Map"]), dtype=mps[v].dtype)
+    #
+    # ESMA loop
+    for t in range(tlen):
+        esma_advance(sim=sim, t=t)
+        #
+        # global variables
+        dct = {v: ser[v][t] for v in globalvars}
+        dct["Tp"] = dct["Tpv"] + dct["Tps"]
+        dct["Ev"] = dct["Evc"] + dct["Evs"]
+        #
+        # scatter domain units back to maps
+        if dom is not None:
+            for v in streamvars:
+                mps_stream[v][mask] = mps[v][ids]
+        else:  # the numpy kernel rebinds new maps at every step
+            for v in streamvars:
+                mps_stream[v] = mps[v]
+        yield {
+            "t": t,
+            "Date": ser["Date"][t],
+            "Series": dct,
+            "Maps": mps_stream,
+        }
+
+
+def simulation_ensemble(
+    series_df,
+    basin,
+    htwi,
+    qt0,
+    cpmax,
+    sfmax,
+    roots,
+    qo,
+    m,
+    lamb,
+    ksat,
+    rho,
+    c,
+    n,
+    k,
+    scale=1000,
+    lat=-30,
+    mode="active",
+    hru_bins=100,
+    fmaps=None,
+):
+    """
+
+    g2g simulation model of a parameter ensemble. All members share the same
+    series, basin and HTWI and are advanced together in the ESMA loop.
+    Simulation maps are shaped (members, units) and PET forcing is computed once.
+
+    Every parameter is a float (same value for all members) or a 1d numpy array
+    of member values. cpmax, sfmax, roots and ksat may also be a 2d map shared by all members,
+    or member values of a 2d index map passed in fmaps.
+
+    :param series_df: pandas dataframe of timeseries
+    :param basin: 2d numpy array of basin area
+    :param htwi: numpy array of HTWI map (positive values only)
+    :param qt0: float or 1d array of initial condition of baseflow in mm/d
+    :param cpmax: float, 1d array or 2d map of canopy water stock capacity in mm
+    :param sfmax: float, 1d array or 2d map of surface water stock capacity in mm
+    :param roots: float, 1d array or 2d map of effective root zone depth in mm
+    :param qo: float or 1d array of full saturation baseflow in mm/d
+    :param m: float or 1d array of the scaling parameter in mm
+    :param lamb: float or 1d array the TWI threshold
+    :param ksat: float, 1d array or 2d map of daily hydraulic conductivity in mm/d
+    :param rho: float or 1d array of root zone depth factor
+    :param c: float or 1d array of Oudin PET model scalar parameter
+    :param n: float or 1d array of number of linear reservoirs (n >= 1)
+    :param k: float or 1d array of detention time of linear reservoirs (k >= 1)
+    :param scale: int value to scale maps
+    :param lat: float of latitude in degrees
+    :param mode: string of simulation domain. Options:
+    'active' - simulate only the active cells of the basin (see active_domain());
+    'hru' - simulate unique hydrologic response units of the basin (see hru_domain()).
+    There is no 'grid' mode: for partial basin masks the 'active' mode averages the PET
+    abstraction over the basin cells only, so members may diverge from
+    simulation(mode='grid') (up to ~0.07 mm of ET in the samples basin)
+    :param hru_bins: int number of HTWI bins in 'hru' mode
+    :param fmaps: None or dict of 2d index maps of cpmax, sfmax, roots or ksat.
+    Member values are multiplied by the index map.
+    :return: python dict containing:
+
+    {'Series': dict of 2d numpy arrays (members, time) of simulated global variables,
+     'Params': dict of 1d numpy arrays of members parameters}
+
+    """
+    # members parameters
+    params = {
+        "qt0": qt0,
+        "cpmax": cpmax,
+        "sfmax": sfmax,
+        "roots": roots,
+        "qo": qo,
+        "m": m,
+        "lamb": lamb,
+        "ksat": ksat,
+        "rho": rho,
+        "c": c,
+        "n": n,
+        "k": k,
+    }
+    if mode not in ["active", "hru"]:
+        # members are advanced on domain units (active may differ from grid, see docs)
+        raise ValueError("Mode '{}' not found. Options: ['active', 'hru']".format(mode))
+    sizes = [len(params[p]) for p in params if np.ndim(params[p]) == 1]
+    if len(set(sizes)) > 1:
+        raise ValueError("Ensemble parameters arrays must have the same size")
+    members = sizes[0] if len(sizes) > 0 else 1
+    #
+    # spatial parameters: 2d maps are packed in the domain, member values are kept aside
+    if fmaps is None:
+        fmaps = dict()
+    spatial = dict()
+    for p in ["cpmax", "sfmax", "roots", "ksat"]:
+        if np.ndim(params[p]) == 2:
+            spatial[p] = params[p]
+        elif p in fmaps:
+            spatial[p] = fmaps[p]
+        else:
+            spatial[p] = 1.0
+    #
+    # deploy simulation domain
+    if mode == "hru":
+        dom = hru_domain(basin=basin, htwi=htwi, bins=hru_bins, **spatial)
+    elif mode == "active":
+        dom = active_domain(basin=basin, htwi=htwi, **spatial)
+    weight = dom["Weight"]
+    wsum = np.sum(weight)
+    print("Domain size : {} units".format(len(weight)))
+    #
+    # broadcast parameters to (members, 1) arrays
+    prms = dict()
+    members_prm = dict()
+    for p in params:
+        if np.ndim(params[p]) == 2:
+            prms[p] = dom[p]
+        else:
+            prms[p] = np.ones(shape=(members, 1)) * np.reshape(params[p], (-1, 1))
+            members_prm[p] = prms[p][:, 0]
+            if p in fmaps:
+                prms[p] = prms[p] * dom[p]
+    #
+    # copy input series
+    df_ts = series_df.copy()
+    tlen = len(df_ts)
+    ts_p = df_ts["P"].values
+    #
+    # compute PET by Oudin model for all members at once
+    ts_days = df_ts["Date"].dt.dayofyear.values
+    lat = lat * np.pi / 180  # convet lat from degrees to radians
+    ts_pet = pet_oudin(
+        temperature=df_ts["T"].values, day=ts_days, latitude=lat, k1=prms["c"]
+    )
+    #
+    # deploy simulation maps
+    shape = (members, len(weight))
+    mps, wrk = esma_buffers(shape=shape)
+    prm = esma_params(
+        htwi=dom["HTWI"],
+        cpmax=prms["cpmax"],
+        sfmax=prms["sfmax"],
+        roots=prms["roots"],
+        ksat=prms["ksat"],
+        rho=prms["rho"],
+        m=prms["m"],
+        lamb=prms["lamb"],
+        count=dom["Count"],
+        scale=scale,
+        axis=1,
+    )
+    #
+    # deploy global series
+    avgvars = esma_avgvars(scale=scale)
+    series = dict()
+    for v in ["D", "Qb"] + list(avgvars):
+        series[v] = np.zeros(shape=(members, tlen), dtype="float64")
+    series["PET"] = ts_pet * np.ones(shape=(members, 1))
+    qo_ = prms["qo"][:, 0]
+    m_ = prms["m"][:, 0]
+    #
+    # get initial global deficit
+    series["D"][:, 0] = topmodel_d0(qt0=prms["qt0"][:, 0], qo=qo_, m=m_)
+    #
+    # ESMA loop
+    for t in range(tlen):
+        # Deficit water balance (backward looking)
+        if t > 0:
+            series["D"][:, t] = (
+                series["D"][:, t - 1]
+                + series["Qb"][:, t - 1]
+                + series["Tps"][:, t - 1]
+                - series["Qv"][:, t - 1]
+            )
+        #
+        # compute maps
+        esma_step_inplace(
+            mps=mps,
+            wrk=wrk,
+            prm=prm,
+            p=ts_p[t] * scale,
+            pet=series["PET"][:, t : t + 1] * scale,
+            d=series["D"][:, t : t + 1],
+            t=t,
+        )
+        #
+        # compute basin-wide averages of all members
+        for v in avgvars:
+            if t == 0 and v in esma_stockvars():
+                pass  # stocks are not balanced in the first step
+            else:
+                series[v][:, t] = (
+                    avgvars[v][0]
+                    * np.round(np.dot(mps[v], weight) / wsum, decimals=4)
+                    / avgvars[v][1]
+                )
+        #
+        # --- Baseflow
+        series["Qb"][:, t] = topmodel_qb(d=series["D"][:, t], qo=qo_, m=m_)
+    #
+    # RUNOFF ROUTING by Nash Cascade of linear reservoirs
+    # members sharing k and n are routed at once
+    series["Qs"] = np.zeros(shape=(members, tlen), dtype="float64")
+    routing = np.stack([prms["k"][:, 0], np.maximum(prms["n"][:, 0], 1.0)], axis=1)
+    routing_sets, routing_ids = np.unique(routing, axis=0, return_inverse=True)
+    for i in range(len(routing_sets)):
+        lcl_members = np.ravel(routing_ids) == i
+        series["Qs"][lcl_members] = nash_cascade(
+            series["R"][lcl_members], k=routing_sets[i, 0], n=routing_sets[i, 1]
+        )
+    #
+    # Compute full discharge Q = Qb + Qs
+    series["Q"] = series["Qb"] + series["Qs"]
+    #
+    # compute global Tp and Ev
+    series["Tp"] = series["Tpv"] + series["Tps"]
+    series["Ev"] = series["Evc"] + series["Evs"]
+    #
+    return {"Series": series, "Params": members_prm}
@@ -89,3 +89,21 @@ def export_asc_raster(array, meta, folder, filename, dtype='float32'):
     return flenm
 
 
+def export_state(state, folder, filename):
+    """
+    Function for exporting a simulation state to a .NPZ file.
+    :param state: dict of simulation state (see model.esma_state())
+    :param folder: string of directory path
+    :param filename: string of file without extension
+    :return: full file name (path and extension) string
+    """
+    dct = {'Date': np.array(state['Date'], dtype='datetime64[D]'),
+           'scale': state['scale'],
+           'Qs': state['Qs']}
+    for v in ['D', 'Qb', 'Tps', 'Qv']:
+        dct[v] = state[v]
+    for v in state['Maps']:
+        dct['map_' + v] = state['Maps'][v]
+    flenm = folder + '/' + filename + '.npz'
+    np.savez(flenm, **dct)
+    return flenm
@@ -0,0 +1,189 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inp
+import model
+
+SAMPLES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "samples"
+)
+
+
+def load_params(days=60):
+    df = pd.read_csv(
+        os.path.join(SAMPLES, "series_obs.txt"), sep=";", parse_dates=["Date"]
+    )
+    meta, htwi = inp.asc_raster(
+        file=os.path.join(SAMPLES, "map_htwi.asc"), dtype="float32"
+    )
+    meta, basin = inp.asc_raster(
+        file=os.path.join(SAMPLES, "map_basin.asc"), dtype="float32"
+    )
+    return dict(
+        series_df=df.iloc[:days].reset_index(drop=True),
+        basin=basin,
+        htwi=htwi,
+        qt0=0.1,
+        cpmax=20,
+        sfmax=30,
+        roots=50,
+        qo=10,
+        m=5,
+        lamb=7.7,
+        ksat=5,
+        rho=0.3,
+        c=110,
+    )
+
+
+def test_stream_maps_match_trace():
+    params = load_params()
+    run = model.simulation(
+        n=2.5, k=1, trace=True, tracevars="D-Cp", backend="numpy", **params
+    )
+    for step in model.simulation_stream(streamvars="D-Cp", backend="numpy", **params):
+        for v in ["D", "Cp"]:
+            trace = run["Trace"][v][step["t"]]
+            assert np.array_equal(step["Maps"][v].astype(trace.dtype), trace), v
+
+
+def test_needs_et_skips_ev_tp():
+    needs = model.esma_needs(seriesvars=["ET"])
+    assert "Ev" not in needs["Maps"]
+    assert "Tp" not in needs["Maps"]
+
+
+def test_labels_qs_warm_start():
+    params = load_params(days=90)
+    series_df = params.pop("series_df")
+    run = model.simulation(
+        series_df=series_df.iloc[:60], n=2.5, k=1, checkpoints=["last"], **params
+    )
+    state0 = list(run["States"].values())[0]
+    # two sub-basins covering the basin
+    labels = np.ones(np.shape(params["basin"]), dtype="int32")
+    labels[:, : np.shape(labels)[1] // 2] = 2
+    run = model.simulation(
+        series_df=series_df.iloc[60:].reset_index(drop=True),
+        n=2.5,
+        k=1,
+        state0=state0,
+        labels=labels,
+        labelvars="Qs",
+        **params
+    )
+    # basin area weights of the labels
+    area = [np.sum(params["basin"] * (labels == lbl)) for lbl in [1, 2]]
+    weights = np.array(area) / np.sum(area)
+    qs = run["Labels"]["Qs"].unstack("Date").loc[[1, 2]].values
+    assert np.allclose(np.dot(weights, qs), run["Series"]["Qs"].values, atol=1e-6)
+
+
+def test_series_does_not_share_input():
+    params = load_params(days=10)
+    series_df = params["series_df"]
+    t0 = series_df["T"].values[0]
+    run = model.simulation(n=2.5, k=1, **params)
+    run["Series"].loc[0, "T"] = t0 + 100
+    run = model.simulation(n=2.5, k=1, frame=False, **params)
+    run["Series"]["T"][0] = t0 + 100
+    assert series_df["T"].values[0] == t0
+
+
+def test_labels_deficit_first_step():
+    params = load_params(days=5)
+    labels = np.ones(np.shape(params["basin"]), dtype="int32")
+    run = model.simulation(
+        n=2.5, k=1, trace=True, tracevars="D", labels=labels, labelvars="D", **params
+    )
+    basin = params["basin"]
+    d_trace = np.sum(run["Trace"]["D"][0] * basin) / np.sum(basin) / 1000
+    d_label = run["Labels"]["D"].values[0]
+    assert d_label > 0
+    assert np.isclose(d_label, d_trace, atol=2e-3)
+
+
+def test_precision_keeps_units():
+    params = load_params(days=30)
+    packed = model.simulation(n=2.5, k=1, backend="inplace", **params)["Series"]
+    single = model.simulation(
+        n=2.5, k=1, backend="inplace", precision="float32", **params
+    )["Series"]
+    for v in ["VSA", "D", "Q", "ET"]:
+        assert np.allclose(packed[v].values, single[v].values, atol=0.05), v
+
+
+def test_backends_match_reference():
+    params = load_params(days=120)
+    check = model.esma_backends_check(
+        backends="inplace", tol=0, reference="numpy", n=2.5, k=1, **params
+    )
+    assert check["inplace"]["OK Flag"], check
+
+
+def test_jit_backend_matches_reference():
+    pytest.importorskip("numba")
+    params = load_params(days=120)
+    check = model.esma_backends_check(
+        backends="jit", tol=0, reference="numpy", n=2.5, k=1, **params
+    )
+    assert check["jit"]["OK Flag"], check
+
+
+def test_events_backend_matches_inplace(monkeypatch):
+    params = load_params(days=120)
+    # spatially varying stocks capacity and compaction of all dry steps
+    params["cpmax"] = 5 + 2 * params["htwi"]
+    params["sfmax"] = 10 + 3 * params["htwi"]
+    monkeypatch.setattr(model, "EVENTS_RATIO", 1.0)
+    compacted = []
+    esma_active = model.esma_active
+
+    def counted(mask, ratio=None):
+        ids = esma_active(mask=mask, ratio=ratio)
+        compacted.append(ids is not None)
+        return ids
+
+    monkeypatch.setattr(model, "esma_active", counted)
+    for mode in ["grid", "active"]:
+        check = model.esma_backends_check(
+            backends="events",
+            tol=0,
+            reference="inplace",
+            mode=mode,
+            n=2.5,
+            k=1,
+            **params
+        )
+        assert check["events"]["OK Flag"], check
+    assert any(compacted)
+
+
+def test_inplace_loop_does_not_allocate():
+    import tracemalloc
+
+    params = load_params(days=200)
+    sim = model.esma_setup(backend="inplace", **params)
+    # warm up
+    for t in range(10):
+        model.esma_advance(sim=sim, t=t)
+    peaks = list()
+    steps = [(10, 30), (30, 190)]
+    for t0, t1 in steps:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        for t in range(t0, t1):
+            model.esma_advance(sim=sim, t=t)
+        growth, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert growth < 1024
+        peaks.append(peak)
+    # a few scalars per step, far below one map and fixed in the step count
+    assert max(peaks) < min(16384, sim["Work"]["tmp1"].nbytes / 4)
+    assert peaks[1] <= peaks[0] + 1024
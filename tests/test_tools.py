@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tools
+
+SAMPLES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "samples"
+)
+
+
+def test_calib_without_bounds_raises(tmp_path):
+    # all parameters fixed: nothing to sample
+    fparams = tmp_path / "param_hydro.txt"
+    with open(os.path.join(SAMPLES, "param_hydro.txt")) as f:
+        lines = f.read().splitlines()
+    rows = [lines[0]]
+    for line in lines[1:]:
+        p, v = line.split(";")[:2]
+        rows.append("{};{};{};{}".format(p, v, v, v))
+    fparams.write_text("\n".join(rows))
+    with pytest.raises(ValueError, match="No parameter to calibrate"):
+        tools.slh_calib_g2g(
+            fseries=os.path.join(SAMPLES, "series_obs.txt"),
+            ftwi=os.path.join(SAMPLES, "map_htwi.asc"),
+            fbasin=os.path.join(SAMPLES, "map_basin.asc"),
+            fparams=str(fparams),
+            size=4,
+            batch=2,
+            folder=str(tmp_path),
+            wkpl=False,
+            tui=False,
+        )
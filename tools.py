@@ -155,6 +155,11 @@ def slh_sim_g2g(
     wkpl=True,
     label="",
     scale=1000,
+    trace_disk=False,
+    spinup=0,
+    spinup_folder="none",
+    cache_folder="none",
+    cache_size=1000,
     tui=True,
 ):
     """
@@ -208,12 +213,21 @@ def slh_sim_g2g(
     :param wkpl: boolean to use folder as workplace
     :param label: string label to output folder
     :param scale: int value to scale maps to integer format (recommended scale >= 1000)
+    :param trace_disk: boolean to store traced maps in memory-mapped files of the trace folder
+    :param spinup: int number of days in the start of the series used to spin-up the
+    initial state (0 to start from qt0 = qo / 100). See model.simulation_spinup()
+    :param spinup_folder: string 'none' or path to folder to cache spin-up states
+    :param cache_folder: string 'none' or path to folder to cache simulation runs, so
+    reruns of the same scenario are loaded from disk (see model.simulation_cached()).
+    Traced maps of cached runs are memory-mapped from the cache (trace_disk is ignored)
+    :param cache_size: float of maximum size of the simulation cache in MB
     :param tui: boolean to screen printouts
     :return:
     """
     import model
     from backend import create_rundir, status
     from visuals import pannel_global
+    import functools
     import os
 
     # folder setup
@@ -267,9 +281,43 @@ def slh_sim_g2g(
             status("importing ksat index map")
         meta, ksat_map = inp.asc_raster(file=fksat, dtype="float32")
         ksat = ksat_map * ksat
+    trace_folder = None
+    if trace:
+        trace_folder = folder + "/trace"
+        os.mkdir(trace_folder)
+    state0 = None
+    if spinup > 0:
+        if tui:
+            status("spinning up initial state")
+        state0 = model.simulation_spinup(
+            series_df=df_series.iloc[:spinup],
+            htwi=twi,
+            basin=basin,
+            cpmax=cpmax,
+            sfmax=sfmax,
+            roots=roots,
+            qo=qo,
+            m=m,
+            lamb=lamb,
+            ksat=ksat,
+            rho=rho,
+            c=c,
+            k=k,
+            n=n,
+            qt0=qt0,
+            lat=-20,
+            scale=scale,
+            cache_folder=None if spinup_folder == "none" else spinup_folder,
+        )
     if tui:
         status("running model")
-    sim = model.simulation(
+    if cache_folder == "none":
+        simulate = model.simulation
+    else:
+        simulate = functools.partial(
+            model.simulation_cached, cache_folder=cache_folder, cache_size=cache_size
+        )
+    sim = simulate(
         series_df=df_series,
         htwi=twi,
         basin=basin,
@@ -291,6 +339,8 @@ def slh_sim_g2g(
         integrate=integrate,
         integratevars=integratevars,
         scale=scale,
+        trace_folder=trace_folder if trace_disk and cache_folder == "none" else None,
+        state0=state0,
     )
     sim_df = sim["Series"]
     if tui:
@@ -307,8 +357,6 @@ def slh_sim_g2g(
         from visuals import export_map_views
 
         tracevars = tracevars.split("-")
-        trace_folder = folder + "/trace"
-        os.mkdir(trace_folder)
         for v in tracevars:
             if tui:
                 status("exporting {} frames".format(v))
@@ -330,9 +378,10 @@ def slh_sim_g2g(
                 ranges = (0, 1)
                 v_scale = 1
             else:
+                # read one map at a time so disk-backed traces stay on disk
                 ranges = (
-                    np.min(sim["Trace"][v]) / scale,
-                    np.max(sim["Trace"][v]) / scale,
+                    min(np.min(lcl_map) for lcl_map in sim["Trace"][v]) / scale,
+                    max(np.max(lcl_map) for lcl_map in sim["Trace"][v]) / scale,
                 )
                 v_scale = scale
             export_map_views(
@@ -696,3 +745,281 @@ def sal_d_by_twi(
             file_path = os.path.join(png_dir, file_name)
             images.append(imageio.imread(file_path))
     imageio.mimsave(gifname, images)
+
+
+def lhs_sample(bounds, size, seed=None):
+    """
+    Latin hypercube sample of parameters
+    :param bounds: dict of parameters names and tuple of (min, max) values
+    :param size: int number of samples
+    :param seed: None, int or numpy SeedSequence of the random generator
+    :return: dict of 1d numpy arrays of sampled values
+    """
+    rng = np.random.default_rng(seed)
+    dct = dict()
+    for p in bounds:
+        # one value in each of the size strata, shuffled
+        strata = (rng.permutation(size) + rng.random(size)) / size
+        dct[p] = bounds[p][0] + strata * (bounds[p][1] - bounds[p][0])
+    return dct
+
+
+def nse(obs, sim):
+    """
+    Nash-Sutcliffe efficiency
+    :param obs: 1d numpy array of observed values
+    :param sim: nd numpy array of simulated values (last axis is time)
+    :return: float or numpy array of NSE
+    """
+    return 1 - np.sum(np.square(sim - obs), axis=-1) / np.sum(
+        np.square(obs - np.mean(obs))
+    )
+
+
+def kge(obs, sim):
+    """
+    Kling-Gupta efficiency
+    :param obs: 1d numpy array of observed values
+    :param sim: nd numpy array of simulated values (last axis is time)
+    :return: float or numpy array of KGE
+    """
+    sim_avg = np.mean(sim, axis=-1, keepdims=True)
+    sim_std = np.std(sim, axis=-1)
+    r = np.mean((sim - sim_avg) * (obs - np.mean(obs)), axis=-1) / (
+        sim_std * np.std(obs)
+    )
+    alpha = sim_std / np.std(obs)
+    beta = sim_avg[..., 0] / np.mean(obs)
+    return 1 - np.sqrt(np.square(r - 1) + np.square(alpha - 1) + np.square(beta - 1))
+
+
+# calibration inputs shared by the pool workers
+_calib_inputs = dict()
+
+
+def _calib_init(inputs):
+    """
+    Pool worker initializer: receive the calibration inputs once per worker
+    :param inputs: dict of calibration inputs
+    :return: none
+    """
+    _calib_inputs.update(inputs)
+
+
+def _calib_batch(batch):
+    """
+    Pool worker task: evaluate one batch of calibration runs
+    :param batch: int batch id
+    :return: pandas dataframe of batch runs
+    """
+    import model
+
+    inputs = _calib_inputs
+    # slice of the batch in the sample of all runs
+    i0 = batch * inputs["batch"]
+    i1 = min(i0 + inputs["batch"], inputs["size"])
+    smp = {p: inputs["sample"][p][i0:i1] for p in inputs["sample"]}
+    params = dict(inputs["fixed"])
+    params.update(smp)
+    ens = model.simulation_ensemble(
+        series_df=inputs["series"],
+        basin=inputs["basin"],
+        htwi=inputs["htwi"],
+        qt0=params["qo"] / 100,
+        cpmax=params["cpmax"],
+        sfmax=params["sfmax"],
+        roots=params["roots"],
+        qo=params["qo"],
+        m=params["m"],
+        lamb=params["lambda"],
+        ksat=params["ksat"],
+        rho=params["rho"],
+        c=params["c"],
+        k=params["k"],
+        n=params["n"],
+        lat=-20,
+        scale=inputs["scale"],
+        fmaps=inputs["fmaps"],
+    )
+    # evaluate streamflow after warm up
+    w = inputs["warmup"]
+    q_obs = inputs["series"]["Q_obs"].values[w:]
+    q_sim = ens["Series"]["Q"][:, w:]
+    df = pd.DataFrame({"Batch": batch, "Run": np.arange(i1 - i0)})
+    for p in smp:
+        df[p] = smp[p]
+    df["NSE"] = nse(obs=q_obs, sim=q_sim)
+    df["KGE"] = kge(obs=q_obs, sim=q_sim)
+    return df
+
+
+def slh_calib_g2g(
+    fseries,
+    ftwi,
+    fbasin,
+    fparams,
+    fcpmax="none",
+    fsfmax="none",
+    froots="none",
+    fksat="none",
+    size=1000,
+    batch=50,
+    workers=None,
+    seed=None,
+    warmup=0,
+    nse_min=0.5,
+    folder="C:/data",
+    wkpl=True,
+    label="",
+    scale=1000,
+    tui=True,
+):
+    """
+
+    Stable LULC Hydrology - g2g mode Monte Carlo / GLUE calibration
+
+    Parameters with Min < Max in the parameters file are drawn by Latin hypercube
+    sampling within bounds. Other parameters are set to the Set value.
+    The Latin hypercube of all runs is drawn once from the seed and split in batches
+    of parameter ensembles (see model.simulation_ensemble()) evaluated in a process
+    pool, so results do not depend on the number of workers.
+
+    Runs are appended to the calib_runs.txt file as batches finish. To resume an
+    interrupted calibration, call again with wkpl=False and folder set to the run folder.
+
+    :param fseries: string path to series .txt file (must have the Q_obs field)
+    :param ftwi: string path to twi .asc file
+    :param fbasin: string path to basin .asc file
+    :param fparams: string path to parameters dataframe .txt file
+    :param fcpmax: string 'none' or path to cpmax .asc file
+    :param fsfmax: string 'none' or path to sfmax .asc file
+    :param froots: string 'none' or path to roots .asc file
+    :param fksat: string 'none' or path to ksat .asc file
+    :param size: int number of calibration runs
+    :param batch: int number of runs in each batch
+    :param workers: int number of worker processes (None for all cpus)
+    :param seed: None or int seed of the sampling (None to draw a fresh seed)
+    :param warmup: int number of warm up days skipped in the evaluation
+    :param nse_min: float of NSE threshold of behavioural runs
+    :param folder: string path to output folder
+    :param wkpl: boolean to use folder as workplace
+    :param label: string label to output folder
+    :param scale: int value to scale maps to integer format (recommended scale >= 1000)
+    :param tui: boolean to screen printouts
+    :return: pandas dataframe of behavioural runs with GLUE likelihood weights
+    """
+    import os
+    from multiprocessing import Pool
+    from backend import create_rundir, status
+
+    # folder setup
+    if wkpl:  # if the passed folder is a workplace, create a sub folder
+        if label != "":
+            label = label + "_"
+        folder = create_rundir(label=label + "CALIB", wkplc=folder)
+    #
+    # calibration setup
+    fsetup = "{}/calib_setup.txt".format(folder)
+    fruns = "{}/calib_runs.txt".format(folder)
+    if os.path.exists(fsetup):
+        # resume: reuse the setup of the interrupted calibration
+        setup_df = pd.read_csv(fsetup, sep=";")
+        seed = int(setup_df["Seed"].values[0])
+        size = int(setup_df["Size"].values[0])
+        batch = int(setup_df["Batch"].values[0])
+    else:
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        setup_df = pd.DataFrame({"Seed": [seed], "Size": [size], "Batch": [batch]})
+        setup_df.to_csv(fsetup, sep=";", index=False)
+    batches = int(np.ceil(size / batch))
+    #
+    # import data
+    if tui:
+        status("importing time series")
+    df_series = pd.read_csv(fseries, sep=";", parse_dates=["Date"])
+    if tui:
+        status("importing twi map")
+    meta, twi = inp.asc_raster(file=ftwi, dtype="float32")
+    if tui:
+        status("importing basin map")
+    meta, basin = inp.asc_raster(file=fbasin, dtype="float32")
+    if tui:
+        status("importing parameters")
+    param_dct, param_df = inp.hydroparams(fhydroparam=fparams)
+    bounds = dict()
+    fixed = dict()
+    for p in [
+        "m",
+        "lambda",
+        "qo",
+        "cpmax",
+        "sfmax",
+        "roots",
+        "ksat",
+        "rho",
+        "c",
+        "k",
+        "n",
+    ]:
+        if param_dct[p]["Min"] < param_dct[p]["Max"]:
+            bounds[p] = (param_dct[p]["Min"], param_dct[p]["Max"])
+        else:
+            fixed[p] = param_dct[p]["Set"]
+    if len(bounds) == 0:
+        raise ValueError(
+            "No parameter to calibrate: set Min < Max in '{}'".format(fparams)
+        )
+    fmaps = dict()
+    fmaps_files = {"cpmax": fcpmax, "sfmax": fsfmax, "roots": froots, "ksat": fksat}
+    for p in fmaps_files:
+        if fmaps_files[p] != "none":
+            if tui:
+                status("importing {} index map".format(p))
+            meta, fmaps[p] = inp.asc_raster(file=fmaps_files[p], dtype="float32")
+    #
+    # get finished batches
+    done = []
+    if os.path.exists(fruns):
+        runs_df = pd.read_csv(fruns, sep=";", float_precision="round_trip")
+        counts = runs_df.groupby("Batch")["Run"].count()
+        sizes = np.minimum(batch, size - counts.index.values * batch)
+        done = list(counts[counts.values == sizes].index)
+        # drop runs of unfinished batches
+        runs_df = runs_df[runs_df["Batch"].isin(done)]
+        runs_df.to_csv(fruns, sep=";", index=False)
+    todo = [b for b in range(batches) if b not in done]
+    if tui:
+        status(
+            "running {} batches of {} runs ({} done)".format(batches, batch, len(done))
+        )
+    #
+    # evaluate batches in the process pool
+    inputs = {
+        "series": df_series,
+        "basin": basin,
+        "htwi": twi,
+        "fmaps": fmaps,
+        "fixed": fixed,
+        "sample": lhs_sample(bounds=bounds, size=size, seed=seed),
+        "size": size,
+        "batch": batch,
+        "warmup": warmup,
+        "scale": scale,
+    }
+    with Pool(processes=workers, initializer=_calib_init, initargs=(inputs,)) as pool:
+        for df in pool.imap_unordered(_calib_batch, todo):
+            # append batch runs
+            header = not os.path.exists(fruns)
+            df.to_csv(fruns, sep=";", index=False, mode="a", header=header)
+            if tui:
+                status("batch {} done".format(df["Batch"].values[0]))
+    #
+    # GLUE: behavioural runs and likelihood weights
+    if tui:
+        status("exporting behavioural runs")
+    runs_df = pd.read_csv(fruns, sep=";")
+    glue_df = runs_df.query("NSE >= {}".format(nse_min)).copy()
+    glue_df["Weight"] = (glue_df["NSE"] - nse_min) / np.sum(glue_df["NSE"] - nse_min)
+    glue_df.to_csv("{}/calib_glue.txt".format(folder), sep=";", index=False)
+    return glue_df
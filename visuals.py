@@ -320,7 +320,8 @@ def export_map_views(
 
     export map views from time series of maps
 
-    :param grd3_map3d: 3d numpy array of maps (time series of maps)
+    :param grd3_map3d: 3d numpy array of maps (time series of maps), memory-mapped array or
+    string path to .npy file of maps (frames are read lazily)
     :param df_series: pandas dataframe of time series
     :param dct_meta: dict of metadata
     :param tpl_ranges: tuple of ranges
@@ -338,6 +339,8 @@ def export_map_views(
     """
     from backend import status
 
+    if isinstance(grd3_map3d, str):
+        grd3_map3d = np.load(grd3_map3d, mmap_mode="r")
     dates_labels = pd.to_datetime(df_series["Date"], format="%Y%m%d")
     dates_labels = dates_labels.astype("str")
     for t in range(len(grd3_map3d)):